@@ -0,0 +1,492 @@
+#encoding=utf-8
+"""
+Process Engine Python API for asyncio.
+Requires Python 3 and aiohttp.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import asyncio
+import base64
+import json
+
+import aiohttp
+
+from fnetpepAPI.fnetpepAPI import _launchData, _workClassOptions
+
+
+class AsyncPEClient(object):
+
+    """asyncio counterpart of PEClient. Receives a server address, port
+    number, login and password, and keeps a single aiohttp session whose
+    connection pool is shared by every request made by the client and by
+    the AsyncPE objects created from it.
+
+    The pool is limited to limit connections in total and limit_per_host
+    connections per server (0 means no limit). timeout is the total number
+    of seconds allowed for each request. A custom aiohttp connector can be
+    passed with connector, in which case the limits are ignored.
+
+    Discovery needs the event loop, so it is run by connect() (or when
+    entering an "async with" block) instead of on creation.
+
+    Usage:
+    >>> from fnetpepAPI.asyncpe import AsyncPEClient, AsyncPE
+    >>> async with AsyncPEClient('server_name', '9080', 'user',
+    'password') as client:
+    ...     pe = AsyncPE(client)
+    ...     queue = await pe.getQueue('workbasket_name')
+    >>> client.apps -> AsyncPEClient variable with available appspaces
+    >>> client.roles -> AsyncPEClient variable with available roles
+    >>> client.workbaskets.keys()-> Dictionary with available Workbaskets
+    >>> client.workflow_classes.keys() -> Dictionary with Workflows.
+    """
+
+    def __init__(self, server, port, user, passwd, scheme='http',
+                 limit=100, limit_per_host=0, timeout=None, connector=None,
+                 bootstrap_workers=8):
+        self.baseurl = '%s://%s:%s/peengine/P8BPMREST/p8/bpm/v1/'%(scheme,
+                                                                   server,
+                                                                   port)
+        self.auth_header = 'Basic ' + base64.b64encode(
+            ('%s:%s' % (user, passwd)).encode('utf-8')).decode('ascii')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.connector = connector
+        self.bootstrap_workers = bootstrap_workers
+        self.session = None
+        self.appspaces = {}
+        self.apps = []
+        self.roles = {}
+        self.workflow_classes = {}
+        self.workbaskets = {}
+        self.queue_urls = []
+
+    async def connect(self):
+
+        """Opens the session and discovers appspaces, roles, workflows and
+        workbaskets. Independent requests run concurrently, at most
+        bootstrap_workers at a time.
+        Usage:
+        >>> client = await AsyncPEClient('server_name', '9080', 'user',
+        'password').connect()
+        """
+        if self.session is None:
+            connector = self.connector or aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout,
+                headers={'Authorization': self.auth_header})
+        slots = asyncio.Semaphore(self.bootstrap_workers)
+
+        async def fetch(uri):
+            async with slots:
+                return await self.get(self.baseurl + uri)
+
+        workflows = asyncio.ensure_future(fetch('workclasses'))
+        appspaces = await fetch('appspacenames')
+        appspaces.raise_for_status()
+        self.appspaces = await appspaces.json()
+        self.apps = list(self.appspaces.keys())
+        role_names = await asyncio.gather(
+            *[fetch(self.appspaces[app]['rolenames']) for app in self.apps])
+        self.roles = {}
+        for app, names in zip(self.apps, role_names):
+            self.roles[app] = list((await names.json()).keys())
+
+        app_roles = [(app, role) for app in self.apps
+                     for role in self.roles[app]]
+        found_roles = await asyncio.gather(
+            *[fetch('appspaces/%s/roles/%s'%app_role)
+              for app_role in app_roles])
+        self.workbaskets = {}
+        self.queue_urls = []
+        found = set()
+        for my_role in found_roles:
+            if my_role.ok:
+                for uri in (await my_role.json())['workbaskets'].values():
+                    if uri['URI'] not in found:
+                        found.add(uri['URI'])
+                        self.queue_urls.append(uri['URI'])
+                    self.workbaskets[uri['URI'].split('/')[-1]] = uri['URI']
+        self.workflow_classes = await (await workflows).json()
+        return self
+
+    async def request(self, method, url, **kwargs):
+
+        """Sends a request through the client's session. The body is read
+        before returning, so the connection goes back to the pool straight
+        away and response.json() / response.text() can still be awaited.
+        Usage:
+        >>> response = await client.request('GET',
+        client.baseurl+'currentuser')
+        """
+        async with self.session.request(method, url, **kwargs) as response:
+            await response.read()
+            return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def close(self):
+
+        """Closes the session and its pooled connections.
+        Usage:
+        >>> await client.close()
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def getLoggedUserInfo(self):
+
+        """Returns a dictionary with logged user information.
+        Usage:
+        >>> user_info = await client.getLoggedUserInfo()
+        """
+        self.userinfo = await (await self.get(self.baseurl
+                                              + 'currentuser')).json()
+        return self.userinfo
+
+
+class AsyncPE(object):
+
+    """asyncio counterpart of PE. An instance from AsyncPEClient must be
+    passed. Methods have the same names, arguments and results as the
+    ones in PE, but must be awaited.
+    Usage:
+    >>> pe = AsyncPE(client)
+    >>> tasks = await pe.getTasks(await pe.getQueue('workbasket_name'))
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def getQueue(self, work_basket):
+
+        """Returns a Queue for a given Workbasket. The Workbasket and its
+        count are requested at the same time.
+        Usage:
+        >>> my_queue = await pe.getQueue('workbasket_name')
+        """
+        url = self.client.baseurl + self.client.workbaskets.get(work_basket)
+        queue, count = await asyncio.gather(
+            self.client.get(url),
+            self.client.get(url + '/queueelements/count'))
+        queue = await queue.json()
+        queue['count'] = (await count.json())['count']
+        return queue
+
+    async def getTasks(self, queue):
+
+        """Returns a list with all tasks for the given queue. An empty list
+        is returned for empty queues.
+        Usage:
+        >>> tasks = await pe.getTasks(my_queue)
+        """
+        work_items = await self.client.get(self.client.baseurl
+                                           + queue.get('queueElements'))
+        return (await work_items.json()).get('queueElements') or []
+
+    async def getStep(self, task):
+
+        """Given a task, returns its current step.
+        Usage:
+        >>> current_step = await pe.getStep(task)
+        """
+        step = await self.client.get(self.client.baseurl
+                                     + task['stepElement'])
+        return await step.json()
+
+    async def lockTask(self, task):
+
+        """Locks the task so other users can't access it at same time. The
+        ETag the task already carries is used, so only one request is sent
+        unless the task changed since it was listed.
+        Usage:
+        >>> await pe.lockTask(task)
+        """
+        return (await self.__lock(task))[0]
+
+    async def __lock(self, task):
+
+        """Locks the task using the ETag it already carries. The step is
+        only read again, to get its current ETag, when the server answers
+        "412 Precondition Failed". Returns the lock response and the ETag
+        it was sent with.
+        """
+        url = self.client.baseurl + task['stepElement']
+        etag = task.get('ETag')
+        locked = await self.client.put(url, params={'action':'lock',
+                                                    'If-Match':etag})
+        if locked.status == 412:
+            step = await self.client.get(url)
+            step.raise_for_status()
+            etag = step.headers.get('ETag')
+            locked = await self.client.put(url, params={'action':'lock',
+                                                        'If-Match':etag})
+        return locked, etag
+
+    async def saveAndUnlockTask(self, task, comment=None, refresh=True):
+
+        """Unlocks the task and saves it, optionally with a comment. The
+        updated task is returned.
+        Usage:
+        >>> task = await pe.saveAndUnlockTask(task, 'Comment added!!!')
+        """
+        url = self.client.baseurl + task['stepElement']
+        params = {'action':'saveAndUnlock', 'If-Match':task['ETag']}
+        try:
+            if comment:
+                step = await self.getStep(task)
+                step['systemProperties']['comment'] = comment
+                await self.lockTask(task)
+                unlocked = await self.client.put(url, params=params,
+                                                 json=step)
+            else:
+                unlocked = await self.client.put(url, params=params)
+            if refresh:
+                task = await self.__refreshTask(task, unlocked)
+        except Exception:
+            await self.abort(task)
+        return task
+
+    async def abort(self, task):
+
+        """Unlocks the task without saving any changes.
+        Usage:
+        >>> await pe.abort(task)
+        """
+        return await self.client.put(self.client.baseurl
+                                     + task['stepElement'],
+                                     params={'action':'abort',
+                                             'If-Match':task['ETag']})
+
+    async def updateTask(self, task, refresh=None, **kwargs):
+
+        """Sets data fields and the selected response of the current step
+        and saves the task. The updated task is returned. Failed updates
+        are aborted and raise a RuntimeError. As in PE.updateTask(), a
+        ValueError is raised when refresh is given and the step has a data
+        field with that name.
+        Usage:
+        >>> task = await pe.updateTask(task, selectedResponse='Approve')
+        """
+        url = self.client.baseurl + task['stepElement']
+        step = await self.getStep(task)
+        if refresh is not None and 'refresh' in (step.get('dataFields')
+                                                 or {}):
+            raise ValueError("Can't tell the data fields of this step "
+                             "from the arguments with the same names: "
+                             "refresh")
+        refresh = refresh is not False
+        for field in step.get('dataFields'):
+            if field in kwargs.keys():
+                if step['dataFields'][field]['mode'] != 1:
+                    step['dataFields'][field]['value'] = kwargs[field]
+                    step['dataFields'][field]['modified'] = True
+
+        for response in step.get('systemProperties').get('responses'):
+            if response in kwargs.values():
+                step['systemProperties']['selectedResponse'] = kwargs[
+                    'selectedResponse']
+
+        await self.lockTask(task)
+        unlocked = await self.client.put(url,
+                                         params={'action':'saveAndUnlock',
+                                                 'If-Match':task['ETag']},
+                                         json=step)
+        try:
+            unlocked.raise_for_status()
+        except Exception as e:
+            await self.abort(task)
+            raise RuntimeError(str(e)+'\n'+await unlocked.text())
+        if refresh:
+            task = await self.__refreshTask(task, unlocked)
+        return task
+
+    async def endTask(self, task, comment=None):
+
+        """Finishes the task, moving it to the next step. Is also possible
+        to create a comment before ending the task.
+        Usage:
+        >>> await pe.endTask(task, 'Completed the task!')
+        """
+        return await self.completeTask(task, comment)
+
+    async def completeTask(self, task, comment=None, response=None,
+                           locked=None, **fields):
+
+        """Finishes the task with two requests, a lock and a dispatch that
+        carries the comment, the selected response and the data fields.
+        Works just like PE.completeTask(): the lock response is returned
+        when the task couldn't be locked, and the task is unlocked again
+        when the step requires a response and none was given or saved.
+        Usage:
+        >>> await pe.completeTask(task, 'Approved!', response='Approve',
+        ICN_Instructions='Done')
+        """
+        if locked is None:
+            locked, etag = await self.__lock(task)
+        else:
+            etag = task.get('ETag')
+        if locked.status >= 400:
+            return locked
+        etag = locked.headers.get('ETag') or etag
+        unlocked = dict(task)
+        unlocked['ETag'] = etag
+        try:
+            step = await locked.json(content_type=None)
+        except ValueError:
+            step = None
+        if not step or 'systemProperties' not in step:
+            step = await self.getStep(task)
+        properties = step['systemProperties']
+
+        if response is not None:
+            if response not in (properties.get('responses') or []):
+                await self.abort(unlocked)
+                raise ValueError("Response '%s' isn't available for this "
+                                 "task" % response)
+            properties['selectedResponse'] = response
+        if properties.get('responses') \
+           and not properties.get('selectedResponse'):
+            await self.abort(unlocked)
+            return "This task needs to be updated. Check the updateTask method."
+        if comment:
+            properties['comment'] = comment
+        for field, value in fields.items():
+            data_field = (step.get('dataFields') or {}).get(field)
+            if data_field and data_field['mode'] != 1:
+                data_field['value'] = value
+                data_field['modified'] = True
+
+        dispatched = await self.client.put(self.client.baseurl
+                                           + task['stepElement'],
+                                           params={'action':'dispatch',
+                                                   'If-Match':etag},
+                                           json=step)
+        if dispatched.status >= 400:
+            await self.abort(unlocked)
+        return dispatched
+
+    async def reassignTask(self, task, destination, comment=None):
+
+        """Reassigns the task to a new designated user, who must exist on
+        the directory service. A comment can be saved before reassigning.
+        Usage:
+        >>> await pe.reassignTask(task, 'p8_user', 'Hey check this out')
+        """
+        if await self.__isUser(destination):
+            if comment:
+                await self.saveAndUnlockTask(task, comment)
+
+            step = await self.client.get(self.client.baseurl
+                                         + task['stepElement'])
+            if (await step.json())['systemProperties']['canReassign']:
+                return await self.client.put(step.url,
+                                             params={'action':'reassign',
+                                                     'participant':
+                                                     destination,
+                                                     'If-Match':
+                                                     step.headers['ETag']})
+            else:
+                return "Task can't be reassigned"
+        else:
+            return "User '%s' not found in Directory Service"%destination
+
+    async def getUser(self, search_string):
+
+        """Looks for search_string in the directory service and returns a
+        list with the matching user names, limited to 50 results, or the
+        message "User not Found".
+        Usage:
+        >>> users = await pe.getUser('user_name')
+        """
+        user = await self.client.get(self.client.baseurl+'users',
+                                     params={'searchPattern':search_string,
+                                             'searchType':4, 'limit':50})
+        found = (await user.json()).get('users')
+        if not found:
+            return "User not Found"
+        return [usr['displayName'] for usr in found]
+
+    async def __isUser(self, name):
+        user = await self.client.get(self.client.baseurl+'users',
+                                     params={'searchPattern':name,
+                                             'searchType':4, 'limit':50})
+        return any(name in (usr.get('name'), usr.get('displayName'))
+                   for usr in (await user.json()).get('users') or [])
+
+    async def startWorkflow(self, **kwargs):
+
+        """Launches a new workflow. Works just like PE.startWorkflow():
+        passing only wf_name returns the fields, groups and attachments
+        available for the workflow, otherwise the new workflow number is
+        returned.
+        Usage:
+        >>> wobnum = await pe.startWorkflow(
+        wf_name='ICNSequentialDocumentApproval', Approvers='user_name')
+        """
+        wf_name = kwargs.get('wf_name')
+
+        if wf_name not in self.client.workflow_classes:
+            return "There's no wf_name key on dictionary or the WorkFlow name\
+ doesn't exist."
+        work_class = await self.client.get(
+            self.client.baseurl
+            + self.client.workflow_classes[wf_name]['URI'],
+            params={'POE':'1'})
+        new_data = await work_class.json()
+
+        if len(kwargs.keys()) <= 1:
+            return _workClassOptions(new_data)
+        new_data = _launchData(new_data, kwargs)
+        wobnum = new_data['systemProperties']['workObjectNumber']
+        started = await self.client.post(self.client.baseurl
+                                         + 'rosters/DefaultRoster/wc/'
+                                         + wf_name+'/wob/'
+                                         + wobnum,
+                                         json=new_data, params={'POE':'1'})
+        started.raise_for_status()
+        text = await started.text()
+        return text.split('\\')[-1].strip('/').strip('}')[:-1]
+
+    async def __refreshTask(self, task, response=None):
+
+        """Returns the task as it is after being saved, using the ETag
+        sent back by the save request or, when there is none, requesting
+        only this task's queue element.
+        """
+        if response is not None and response.ok \
+           and response.headers.get('ETag'):
+            task = dict(task)
+            task['ETag'] = response.headers['ETag']
+            return task
+        for k, v in self.client.workbaskets.items():
+            if task.get('queueName') in v:
+                found = await self.client.get(
+                    self.client.baseurl + v + '/queueelements',
+                    params={'filter':'F_WobNum = :A',
+                            'subsVars':json.dumps([task['workObjectNumber']]),
+                            'pageSize':1})
+                if found.ok:
+                    for newtask in (await found.json()).get(
+                            'queueElements') or []:
+                        if newtask['workObjectNumber'] == task[
+                                'workObjectNumber']:
+                            return newtask
+        return task
@@ -0,0 +1,121 @@
+#encoding=utf-8
+"""
+Caches used by the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    """Thread safe dictionary-like cache holding at most maxsize entries.
+    When full, the least recently used entry is evicted. A maxsize of 0
+    disables the cache. With ttl, entries expire ttl seconds after being
+    stored. Lookups are counted as hits or misses.
+    Usage:
+    >>> cache = LRUCache(maxsize=256, ttl=600)
+    >>> cache.set('key', 'value')
+    >>> cache.get('key') -> 'value'
+    >>> cache.stats() -> {'hits': 1, 'misses': 0, 'evictions': 0, ...}
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+
+    def get(self, key, default=None):
+
+        """Returns the value for key, or default when it isn't cached.
+        """
+        with self.__lock:
+            if key in self:
+                self.hits += 1
+                return self.peek(key)
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+
+        """Same as get(), but the lookup isn't counted. Use record() when
+        the hit or miss is only known later, like after a conditional
+        request.
+        """
+        with self.__lock:
+            if key not in self:
+                return default
+            entry = self.__entries.pop(key)
+            self.__entries[key] = entry
+            return entry[0]
+
+    def record(self, hit):
+
+        """Counts one hit (hit=True) or miss (hit=False).
+        """
+        with self.__lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, key, value, ttl=None):
+
+        """Stores value for key, evicting the least recently used entries
+        if the cache is full. ttl overrides the cache's ttl for this entry.
+        """
+        if self.maxsize <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (value, expires)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+
+        """Removes key from the cache, if it is there.
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+
+        """Removes every entry. Counters are kept.
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+
+        """Returns a dictionary with the cache's counters and size.
+        """
+        with self.__lock:
+            return {'hits':self.hits, 'misses':self.misses,
+                    'evictions':self.evictions,
+                    'size':len(self.__entries), 'maxsize':self.maxsize}
+
+    def __contains__(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                return False
+            expires = self.__entries[key][1]
+            if expires is not None and expires <= time.time():
+                del self.__entries[key]
+                return False
+            return True
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
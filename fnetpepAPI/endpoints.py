@@ -0,0 +1,161 @@
+#encoding=utf-8
+"""
+Process Engine cluster support for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import re
+import threading
+import time
+from fnetpepAPI.cache import LRUCache
+
+LEAST_OUTSTANDING = 'least_outstanding'
+ROUND_ROBIN = 'round_robin'
+
+_TASK_URI = re.compile(r'/(?:stepelements|wob)/([^/?]+)')
+
+
+class EndpointPool(object):
+
+    """Spreads requests over the nodes of a Process Engine cluster, given
+    as a list of URLs like 'https://node1:9443'. Each request goes to the
+    node with the fewest requests in flight (strategy=LEAST_OUTSTANDING)
+    or to the next node in turn (strategy=ROUND_ROBIN).
+
+    Node health is tracked from the requests themselves: after max_failures
+    failures in a row (errors, timeouts or 5xx statuses) a node is ejected
+    for eject_for seconds. Once that time is over, it is tried again by a
+    single request, and goes back into the pool if it succeeds. When every
+    node is ejected, requests go to the one ejected first.
+
+    With sticky=True, the requests about one task (its step element, locks,
+    saves and dispatches, and its milestones) go to the node that got the
+    first of them, while that node is healthy.
+    Usage:
+    >>> pool = EndpointPool(['http://node1:9080', 'http://node2:9080'],
+    sticky=True)
+    >>> client = PEClient(pool, None, 'user', 'password')
+    >>> pool.stats()['http://node1:9080'] -> {'outstanding': 2, ...}
+    """
+
+    def __init__(self, endpoints, strategy=LEAST_OUTSTANDING, sticky=False,
+                 max_failures=3, eject_for=30.0, sticky_size=10000):
+        if not endpoints:
+            raise ValueError('At least one endpoint is needed')
+        if strategy not in (LEAST_OUTSTANDING, ROUND_ROBIN):
+            raise ValueError('Unknown strategy: %r' % (strategy,))
+        self.endpoints = [endpoint.rstrip('/') for endpoint in endpoints]
+        self.strategy = strategy
+        self.sticky = sticky
+        self.max_failures = max_failures
+        self.eject_for = eject_for
+        self.routes = LRUCache(sticky_size)
+        self.__nodes = dict((endpoint, {'outstanding': 0, 'requests': 0,
+                                        'failures': 0, 'failed': 0,
+                                        'ejections': 0, 'ejected_until': None,
+                                        'trying': False})
+                            for endpoint in self.endpoints)
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def root(self):
+        """The URL used to build request URLs before they are routed."""
+        return self.endpoints[0]
+
+    def acquire(self, url, exclude=(), node=None):
+        """Picks the node for a request to url, avoiding those in exclude
+        when possible, and returns it along with url pointed at it. Passing
+        node sends the request to that node whatever its health. The node
+        must be given back to release().
+        """
+        key = None
+        if self.sticky:
+            found = _TASK_URI.search(url)
+            key = found.group(1) if found else None
+        with self.__lock:
+            now = time.time()
+            endpoint = node or (self.routes.peek(key) if key else None)
+            if node is None and (endpoint is None or endpoint in exclude
+                                 or not self.__available(endpoint, now)):
+                endpoint = self.__pick(now, exclude)
+                if key:
+                    self.routes.set(key, endpoint)
+            node = self.__nodes[endpoint]
+            if node['ejected_until'] is not None:
+                node['trying'] = True
+            node['outstanding'] += 1
+            node['requests'] += 1
+        for root in self.endpoints:
+            if url.startswith(root):
+                url = endpoint + url[len(root):]
+                break
+        return endpoint, url
+
+    def release(self, endpoint, failed=False):
+        """Records the outcome of a request sent to endpoint. failed=None
+        means the request said nothing about the node's health.
+        """
+        with self.__lock:
+            node = self.__nodes[endpoint]
+            node['outstanding'] -= 1
+            trying, node['trying'] = node['trying'], False
+            if failed is None:
+                return
+            if not failed:
+                node['failed'] = 0
+                node['ejected_until'] = None
+                return
+            node['failures'] += 1
+            node['failed'] += 1
+            if trying or node['failed'] >= self.max_failures:
+                if node['ejected_until'] is None or trying:
+                    node['ejections'] += 1
+                node['ejected_until'] = time.time() + self.eject_for
+
+    def healthy(self):
+        """Returns the nodes requests can be sent to right now."""
+        with self.__lock:
+            now = time.time()
+            return [endpoint for endpoint in self.endpoints
+                    if self.__available(endpoint, now)]
+
+    def stats(self):
+        """Returns a dictionary with the counters of each node: requests in
+        flight (outstanding), requests, failures, ejections and whether it
+        is ejected right now.
+        """
+        with self.__lock:
+            now = time.time()
+            stats = {}
+            for endpoint, node in self.__nodes.items():
+                stats[endpoint] = dict(
+                    (key, node[key]) for key in ('outstanding', 'requests',
+                                                 'failures', 'ejections'))
+                stats[endpoint]['ejected'] = not self.__available(endpoint,
+                                                                  now)
+            return stats
+
+    def __available(self, endpoint, now):
+        """Tells whether a node can take requests: it isn't ejected, or its
+        ejection is over and no request is trying it yet.
+        """
+        node = self.__nodes[endpoint]
+        until = node['ejected_until']
+        return until is None or (until <= now and not node['trying'])
+
+    def __pick(self, now, exclude=()):
+        candidates = [endpoint for endpoint in self.endpoints
+                      if self.__available(endpoint, now)
+                      and endpoint not in exclude]
+        if not candidates:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in exclude] or self.endpoints
+            return min(candidates,
+                       key=lambda e: self.__nodes[e]['ejected_until'] or 0)
+        if self.strategy == ROUND_ROBIN:
+            self.__next += 1
+            return candidates[self.__next % len(candidates)]
+        return min(candidates, key=lambda e: (self.__nodes[e]['outstanding'],
+                                              self.__nodes[e]['requests']))
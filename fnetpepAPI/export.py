@@ -0,0 +1,238 @@
+#encoding=utf-8
+"""
+Streaming export of Queues for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+
+Usage:
+$ fnetpep-export server_name 9080 p8admin --format csv -o tasks.csv
+$ fnetpep-export server_name 9080 p8admin -w Invoices -w Inbox \
+  --checkpoint export.ckpt -o tasks.ndjson
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import getpass
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+COLUMNS = ('workbasket', 'workObjectNumber', 'queueName', 'stepName',
+           'subject', 'comment', 'dataFields', 'milestones')
+
+
+def export(pe, out, workbaskets=None, format='ndjson', workers=8,
+           read_ahead=None, page_size=500, milestones=True, checkpoint=None,
+           checkpoint_every=100):
+    """Writes one record per task of the given Workbaskets (all of them by
+    default) to the file object out, as NDJSON or CSV, and returns a
+    dictionary with the number of tasks exported and the time it took.
+
+    Tasks are listed page by page, and their steps (and milestones) are
+    fetched by up to workers threads, up to read_ahead tasks (4 times
+    workers by default) ahead of the one being written. Records are
+    written in Queue order as soon as they are ready, so memory use
+    doesn't depend on the amount of tasks.
+
+    With checkpoint (a file path), the progress is saved every
+    checkpoint_every tasks, and an interrupted export started again with
+    the same checkpoint continues where it stopped; out must then be
+    opened for appending. Tasks are listed ordered by work object number,
+    and a Workbasket is resumed by asking the server only for the tasks
+    after the last one written, so nothing is downloaded twice. Tasks added
+    in between with a lower work object number are not exported. The
+    checkpoint is also saved when the export fails or is interrupted, so
+    records are only written twice when the process is killed. The
+    checkpoint is removed when the export finishes.
+    Usage:
+    >>> with open('tasks.ndjson', 'a') as out:
+    ...     export(pe, out, ['Invoices'], checkpoint='tasks.ckpt')
+    -> {'tasks': 5000, 'elapsed': 12.3}
+    """
+    if format not in ('ndjson', 'csv'):
+        raise ValueError("format must be 'ndjson' or 'csv'")
+    if read_ahead is None:
+        read_ahead = workers * 4
+    names = sorted(workbaskets or pe.client.workbaskets)
+    state = _loadCheckpoint(checkpoint)
+    write = _writer(out, format, header=state is None)
+    state = state or {'done': [], 'workbasket': None, 'last': None,
+                      'written': 0}
+    started = time.time()
+    exported = 0
+
+    def details(name, task):
+        step = pe.getStep(task)
+        record = {'workbasket': name,
+                  'workObjectNumber': task.get('workObjectNumber'),
+                  'queueName': task.get('queueName'),
+                  'stepName': task.get('stepName'),
+                  'subject': step['systemProperties'].get('subject',
+                                                          task.get('subject')),
+                  'comment': step['systemProperties'].get('comment'),
+                  'dataFields': dict(
+                      (field, value.get('value')) for field, value in
+                      (step.get('dataFields') or {}).items())}
+        if milestones and task.get('milestones'):
+            record['milestones'] = pe.getMilestones(task)
+        return record
+
+    def flush(pending, limit):
+        """Writes the oldest records until at most limit are pending."""
+        while len(pending) > limit:
+            record = pending.popleft().result()
+            write(record)
+            state['last'] = record['workObjectNumber']
+            state['written'] += 1
+            if checkpoint and state['written'] % checkpoint_every == 0:
+                out.flush()
+                _saveCheckpoint(checkpoint, state)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name in names:
+                if name in state['done']:
+                    continue
+                last = state['last'] if state['workbasket'] == name else None
+                state['workbasket'], state['last'] = name, last
+                query = {'orderBy': 'F_WobNum'}
+                if last is not None:
+                    query['filter'] = 'F_WobNum > :A'
+                    query['subsVars'] = json.dumps([last])
+                queue = {'name': name,
+                         'queueElements': (pe.client.workbaskets[name]
+                                           + '/queueelements'),
+                         'query': query}
+                pending = deque()
+                for task in pe.iterTasks(queue, page_size):
+                    pending.append(pool.submit(details, name, task))
+                    exported += 1
+                    flush(pending, read_ahead)
+                flush(pending, 0)
+                state['done'].append(name)
+                state['workbasket'], state['last'] = None, None
+                if checkpoint:
+                    out.flush()
+                    _saveCheckpoint(checkpoint, state)
+    except BaseException:
+        if checkpoint:
+            out.flush()
+            _saveCheckpoint(checkpoint, state)
+        raise
+    out.flush()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return {'tasks': exported, 'elapsed': time.time() - started}
+
+
+def _writer(out, format, header):
+    """Returns a function writing one record to out."""
+    if format == 'ndjson':
+        def write(record):
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+        return write
+
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(COLUMNS)
+
+    def write(record):
+        row = []
+        for column in COLUMNS:
+            value = record.get(column)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, sort_keys=True)
+            elif value is None:
+                value = ''
+            if sys.version_info[0] < 3 and isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        writer.writerow(row)
+    return write
+
+
+def _loadCheckpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as checkpoint:
+        return json.load(checkpoint)
+
+
+def _saveCheckpoint(path, state):
+    """Writes the checkpoint atomically, so an interruption never leaves a
+    partial file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'w') as checkpoint:
+        json.dump(state, checkpoint)
+    if hasattr(os, 'replace'):
+        os.replace(temp, path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+
+
+def main(argv=None):
+    """Entry point of the fnetpep-export console script."""
+    from fnetpepAPI.fnetpepAPI import PEClient, PE
+
+    parser = argparse.ArgumentParser(
+        description='Exports Process Engine Queues with their step data.')
+    parser.add_argument('server')
+    parser.add_argument('port')
+    parser.add_argument('user')
+    parser.add_argument('--password', default=os.environ.get(
+        'FNETPEP_PASSWORD'), help='defaults to $FNETPEP_PASSWORD, or is '
+                        'asked for')
+    parser.add_argument('--scheme', default='http')
+    parser.add_argument('-w', '--workbasket', action='append',
+                        dest='workbaskets', help='Workbasket to export '
+                        '(repeat for more); all of them by default')
+    parser.add_argument('-f', '--format', choices=('ndjson', 'csv'),
+                        default='ndjson')
+    parser.add_argument('-o', '--output', help='defaults to stdout, '
+                        'appended to when resuming from a checkpoint')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--no-milestones', action='store_true')
+    parser.add_argument('--checkpoint', help='file used to resume an '
+                        'interrupted export')
+    options = parser.parse_args(argv)
+    password = options.password or getpass.getpass()
+
+    client = PEClient(options.server, options.port, options.user, password,
+                      scheme=options.scheme, lazy=True,
+                      pool_maxsize=options.workers)
+    pe = PE(client)
+    out = sys.stdout
+    if options.output:
+        resuming = options.checkpoint and os.path.exists(options.checkpoint)
+        mode = 'a' if resuming else 'w'
+        if sys.version_info[0] < 3:
+            out = open(options.output, mode + 'b')
+        else:
+            out = open(options.output, mode, newline='')
+    try:
+        result = export(pe, out, workbaskets=options.workbaskets,
+                        format=options.format, workers=options.workers,
+                        page_size=options.page_size,
+                        milestones=not options.no_milestones,
+                        checkpoint=options.checkpoint)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        client.close()
+    print('Exported %(tasks)d tasks in %(elapsed).1f seconds.' % result,
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,61 @@ copyright: (c) 2016 by Wanderley Souza.
 license: Apache2, see LICENSE for more details.
 """
 
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
 import requests
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from datetime import datetime
+from fnetpepAPI.cache import LRUCache
+from fnetpepAPI.endpoints import EndpointPool
+from fnetpepAPI.limiter import RequestLimiter
+from fnetpepAPI.task import Task
+from fnetpepAPI.metrics import (Metrics, currentOperation, inheritOperation,
+                                instrumented)
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+TaskResult = namedtuple('TaskResult', 'task ok status error elapsed result')
+LaunchResult = namedtuple('LaunchResult', 'row ok wobnum error elapsed')
+QueueCounts = namedtuple('QueueCounts', 'counts errors cached elapsed')
+
+
+class _Flight(object):
+
+    """A GET being sent on behalf of every caller asking for it."""
+
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def _flightKey(url, kwargs):
+    """Returns the key identifying identical GETs, or None when the
+    request can't be shared (streamed, or with other options than params,
+    headers and timeout).
+    """
+    if set(kwargs) - set(['params', 'headers', 'timeout']):
+        return None
+    params, headers = kwargs.get('params'), kwargs.get('headers')
+    return (url.split('?')[0], url,
+            json.dumps(params, sort_keys=True, default=str) if params
+            else None,
+            tuple(sorted(headers.items())) if headers else None)
+
 
 class PEClient(object):
     
@@ -23,76 +75,566 @@ class PEClient(object):
     >>> client.roles -> PEClient variable with available roles
     >>> client.workbaskets.keys()-> Dictionary with available Workbaskets
     >>> client.workflow_classes.keys() -> Dictionary with Workflows.
+
+    Every request goes through a pooled requests.Session owned by the
+    client, so connections (and the Basic auth header) are reused between
+    calls. The pool can be tuned with pool_connections (number of hosts
+    kept), pool_maxsize (connections kept per host), pool_block (wait for
+    a free connection instead of opening extra ones) and max_retries.
+    timeout (seconds, or a (connect, read) tuple) is applied to every call
+    that doesn't set its own. A custom transport adapter can be passed
+    with adapter, in which case the pool options are ignored.
+
+    >>> client = PEClient('server_name', '9443', 'user', 'password',
+    scheme='https', pool_maxsize=20, timeout=(3.05, 30))
+
+    Discovery runs on up to bootstrap_workers threads. The number of
+    requests it made and the time it took are kept in bootstrap_stats.
+    >>> client.bootstrap_stats -> {'requests': 23, 'elapsed': 0.41}
+
+    With lazy=True nothing is discovered when the client is created:
+    apps, roles, workflow_classes and workbaskets are fetched the first
+    time they are used. Discovered data can be kept on disk by passing a
+    cache_dir; it is shared by every client created for the same server
+    and user until cache_ttl seconds have passed or invalidateCache() is
+    called.
+    >>> client = PEClient('server_name', '9080', 'user', 'password',
+    lazy=True, cache_dir='/var/tmp/fnetpep', cache_ttl=3600)
+
+    Response bodies are decoded once, no matter how many times json() is
+    called on a response, using decoder. Payloads passed with json= are
+    encoded with encoder. Both default to the json module, and can be
+    replaced by a faster library with the same interface.
+    >>> import ujson
+    >>> client = PEClient('server_name', '9080', 'user', 'password',
+    decoder=ujson.loads, encoder=ujson.dumps)
+
+    Requests are measured in client.metrics, tagged with the PEClient or
+    PE method that made them. Pass a Metrics instance to share it between
+    clients, or metrics=None to turn measuring off.
+    >>> client.metrics.snapshot()['endTask'] -> {'calls': 3, ...}
+
+    With limiter=True, the number of requests sent at the same time is
+    limited, with separate limits for reads and writes that grow while
+    the server answers well and shrink on errors and latency spikes (see
+    fnetpepAPI.limiter). A RequestLimiter can be passed instead, to tune
+    it or share it between clients.
+    >>> client = PEClient('server_name', '9080', 'user', 'password',
+    limiter=True)
+    >>> client.limiter.stats()['writes'] -> {'limit': 3.5, 'waiting': 2, ...}
+
+    With coalesce=True, identical GETs (same URL, parameters and headers)
+    sent while one of them is still waiting for its response share that
+    response, decoded body included, so it must not be modified. A PUT or
+    POST to a URL keeps later GETs from joining requests sent before it.
+    coalesced_count holds how many requests were answered this way.
+    >>> client = PEClient('server_name', '9080', 'user', 'password',
+    coalesce=True)
+
+    server can also be a list with the nodes of a Process Engine cluster
+    (given as 'name' or 'name:port'), and requests are spread over them.
+    Pass an EndpointPool instead to choose how, or to keep the requests
+    about a task on a single node (see fnetpepAPI.endpoints).
+    >>> client = PEClient(['node1', 'node2', 'node3:9081'], '9080', 'user',
+    'password')
+    >>> client.endpoints.stats() -> {'http://node1:9080': {...}, ...}
+
+    With session_auth=True, credentials are only sent until the server
+    answers with a session cookie (like WebSphere's LtpaToken2), which
+    is used for the requests after that, sparing a directory lookup on
+    the server per request. When the session expires, the next request
+    logs in again; the number of successful logins is kept in logins.
+    While the credentials are refused, each request is sent only once,
+    with Basic auth. Servers that don't issue a cookie get Basic auth on
+    every request, as usual. Each node of a cluster gets its own login.
+    >>> client = PEClient('server_name', '9080', 'user', 'password',
+    session_auth=True)
     """
     
-    def __init__(self, server, port, user, passwd):
-        self.baseurl = 'http://%s:%s/peengine/P8BPMREST/p8/bpm/v1/'%(server,
-                                                                     port)
+    def __init__(self, server, port, user, passwd, scheme='http',
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 max_retries=0, timeout=None, adapter=None,
+                 bootstrap_workers=8, lazy=False, cache_dir=None,
+                 cache_ttl=3600, metrics=True, decoder=json.loads,
+                 encoder=json.dumps, limiter=None, coalesce=False,
+                 session_auth=False):
+        self.endpoints = None
+        if isinstance(server, EndpointPool):
+            self.endpoints = server
+        elif isinstance(server, (list, tuple)):
+            self.endpoints = EndpointPool([
+                '%s://%s' % (scheme, node if ':' in node
+                             else '%s:%s' % (node, port))
+                for node in server])
+        if self.endpoints is not None:
+            self.baseurl = (self.endpoints.root
+                            + '/peengine/P8BPMREST/p8/bpm/v1/')
+        else:
+            self.baseurl = '%s://%s:%s/peengine/P8BPMREST/p8/bpm/v1/'%(
+                scheme, server, port)
         self.cred = HTTPBasicAuth(user, passwd)
-        self.workbaskets = {}
-        self.queue_urls = []
-        self.__getAppSpaces()
-        self.__getRoles()
-        self.__getWorkFlowNames()
-        self.__getQueues()
+        self.session_auth = session_auth
+        self.logins = 0
+        self.__sessions = {}
+        self.__auth_lock = threading.Lock()
+        self.timeout = timeout
+        self.decoder = decoder
+        self.encoder = encoder
+        self.session = requests.Session()
+        if not session_auth:
+            self.session.auth = self.cred
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize,
+                                  pool_block=pool_block,
+                                  max_retries=max_retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.bootstrap_workers = bootstrap_workers
+        self.metrics = Metrics() if metrics is True else metrics
+        self.limiter = RequestLimiter() if limiter is True else limiter
+        self.coalesce = coalesce
+        self.coalesced_count = 0
+        self.__flights = {}
+        self.__flights_lock = threading.Lock()
+        self.request_count = 0
+        self.__count_lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.bootstrap_stats = {'requests':0, 'elapsed':0.0, 'cached':False}
+        self.__discovered = {}
+        self.__discovery_lock = threading.RLock()
+        self.__cache_created = None
+        self.__loadCache()
+        if not lazy:
+            self.__bootstrap()
+
+    @property
+    def appspaces(self):
+        return self.__discover('appspaces')
+
+    @property
+    def apps(self):
+        return self.__discover('apps')
+
+    @property
+    def roles(self):
+        return self.__discover('roles')
+
+    @property
+    def workflow_classes(self):
+        return self.__discover('workflow_classes')
+
+    @property
+    def workbaskets(self):
+        return self.__discover('workbaskets')
+
+    @property
+    def queue_urls(self):
+        return self.__discover('queue_urls')
+
+    def __discover(self, name):
+
+        """Returns the discovered value for name, fetching it (and only
+        what it depends on) if it hasn't been fetched yet.
+        """
+        if name not in self.__discovered:
+            with self.__discovery_lock:
+                if name not in self.__discovered:
+                    self.__bootstrap([name])
+        return self.__discovered[name]
+
+    @instrumented
+    def __bootstrap(self, names=None):
+
+        """Discovers appspaces, roles, workflows and workbaskets, or only
+        those needed for names. Calls that don't depend on each other run
+        in parallel on a pool limited to bootstrap_workers threads. How
+        many requests were made and how long it took are added to the
+        bootstrap_stats variable.
+        """
+        names = set(names or ['workflow_classes', 'workbaskets'])
+        missing = names - set(self.__discovered)
+        if not missing:
+            return
+        started = time.time()
+        first_request = self.request_count
+        with self.__discovery_lock:
+            with ThreadPoolExecutor(
+                    max_workers=self.bootstrap_workers) as pool:
+                workflows = None
+                if 'workflow_classes' in missing:
+                    workflows = pool.submit(
+                        inheritOperation(self.__getWorkFlowNames))
+                if missing - set(['workflow_classes']):
+                    if 'roles' not in self.__discovered:
+                        self.__getAppSpaces()
+                        self.__getRoles(pool)
+                    if missing & set(['workbaskets', 'queue_urls']):
+                        self.__getQueues(pool)
+                if workflows:
+                    workflows.result()
+            self.__saveCache()
+        self.bootstrap_stats['requests'] += self.request_count - first_request
+        self.bootstrap_stats['elapsed'] += time.time() - started
+
+    def __cacheFile(self):
+
+        """Returns the path of the discovery cache file for this server and
+        user, or None when no cache_dir was given.
+        """
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha1((self.baseurl + '|'
+                            + self.cred.username).encode('utf-8'))
+        return os.path.join(self.cache_dir,
+                            'fnetpep-%s.json'%key.hexdigest())
+
+    def __loadCache(self):
+
+        """Loads previously discovered data from the cache file, unless it
+        is missing, unreadable or older than cache_ttl seconds.
+        """
+        path = self.__cacheFile()
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path) as cache:
+                cached = json.load(cache)
+        except (IOError, OSError, ValueError):
+            return
+        if time.time() - cached.get('created', 0) > self.cache_ttl:
+            return
+        self.__cache_created = cached['created']
+        self.__discovered.update(cached.get('data', {}))
+        self.bootstrap_stats['cached'] = True
+
+    def __saveCache(self):
+
+        """Writes everything discovered so far to the cache file. The file
+        is replaced atomically, so concurrent processes never read a
+        partially written cache. The cache is only an optimization: when
+        cache_dir can't be written, nothing is saved and the client works
+        as if no cache_dir had been given.
+        """
+        path = self.__cacheFile()
+        if not path:
+            return
+        if self.__cache_created is None:
+            self.__cache_created = time.time()
+        temp = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            handle, temp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(handle, 'w') as cache:
+                json.dump({'baseurl':self.baseurl,
+                           'user':self.cred.username,
+                           'created':self.__cache_created,
+                           'data':self.__discovered}, cache)
+            getattr(os, 'replace', os.rename)(temp, path)
+        except (IOError, OSError):
+            if temp is not None and os.path.exists(temp):
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+
+    def invalidateCache(self):
+
+        """Removes this client's cache file and forgets everything
+        discovered so far. Apps, roles, workflows and workbaskets will be
+        fetched again the next time they are used.
+        Usage:
+        >>> client.invalidateCache()
+        """
+        with self.__discovery_lock:
+            path = self.__cacheFile()
+            if path and os.path.exists(path):
+                os.remove(path)
+            self.__discovered = {}
+            self.__cache_created = None
 
     def __getAppSpaces(self):
         
         """Returns a list with the name of availables appspaces on FileNet,
         to apps variable.
         """        
+        appspaces = self.get(self.baseurl+'appspacenames')
         try:
-            appspaces = requests.get(self.baseurl+'appspacenames',
-                                     auth=self.cred)
             appspaces.raise_for_status()
-            self.appspaces = appspaces.json()            
-            self.apps = appspaces.json().keys()
-            
+            names = appspaces.json()
         except Exception as e:
-            print (str(e)+':\n'+str(appspaces.json()['UserMessage']['Text']))
-            print (appspaces.json())
-            self.apps =  appspaces.json()
+            print (str(e)+':\n'+appspaces.text)
+            raise
+        self.__discovered['appspaces'] = names
+        self.__discovered['apps'] = list(names.keys())
         
-    def __getRoles(self):
+    def __getRoles(self, pool):
         
         """Returns a dictionary with role names and it's queues to a roles
         variable.
         """
-        roles = {}
-        for a in self.apps:
-            url = self.appspaces[a]['rolenames']            
-            role = requests.get(self.baseurl+url, auth=self.cred)            
-            roles[a] = role.json().keys()
-        self.roles = roles
+        def fetch(app):
+            url = self.appspaces[app]['rolenames']
+            return list(self.get(self.baseurl+url).json().keys())
+
+        self.__discovered['roles'] = dict(zip(self.apps,
+                                              pool.map(inheritOperation(fetch),
+                                                       self.apps)))
     
     def __getWorkFlowNames(self):
         
         """Sets all available WorkFlows into workflow_classes variable.
         """
-        workflow_names = requests.get(self.baseurl+'workclasses',
-                                      auth=self.cred).json()        
-        self.workflow_classes = workflow_names 
+        workflow_names = self.get(self.baseurl+'workclasses').json()        
+        self.__discovered['workflow_classes'] = workflow_names
     
-    def __getQueues(self):
+    def __getQueues(self, pool):
         
         """Creates a list with URL adresses from workbaskets. Also creates a
         dictionary with workbasket name as key and it's URL as value.
+        Each role is requested once, from the appspace it belongs to.
+        """
+        app_roles = [(app, role) for app in self.apps
+                     for role in self.roles[app]]
+
+        def fetch(app_role):
+            return self.get(self.baseurl+'appspaces/%s/roles/%s'%app_role)
+
+        queue_urls = []
+        workbaskets = {}
+        found = set()
+        for my_role in pool.map(inheritOperation(fetch), app_roles):
+            if my_role.ok:
+                for uri in my_role.json()['workbaskets'].values():
+                    if uri['URI'] not in found:
+                        found.add(uri['URI'])
+                        queue_urls.append(uri['URI'])
+                    workbaskets[uri['URI'].split('/')[-1]] = uri['URI']
+        self.__discovered['workbaskets'] = workbaskets
+        self.__discovered['queue_urls'] = queue_urls
+
+    def request(self, method, url, **kwargs):
+
+        """Sends a request through the client's pooled session. Accepts the
+        same keyword arguments as requests.Session.request(). A json=
+        payload is encoded with the client's encoder, and the response's
+        json() decodes the body only once, with the client's decoder.
+        Usage:
+        >>> response = client.request('GET', client.baseurl+'currentuser')
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if kwargs.get('json') is not None:
+            body = self.encoder(kwargs.pop('json'))
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            headers = dict(kwargs.get('headers') or {})
+            headers.setdefault('Content-Type', 'application/json')
+            kwargs['headers'] = headers
+            kwargs['data'] = body
+        if not self.coalesce:
+            return self.__send(method, url, **kwargs)
+        if method.upper() != 'GET':
+            self.__forget(url)
+            return self.__send(method, url, **kwargs)
+        key = _flightKey(url, kwargs)
+        if key is None:
+            return self.__send(method, url, **kwargs)
+        with self.__flights_lock:
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__flights[key] = _Flight()
+            else:
+                self.coalesced_count += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = self.__send(method, url, **kwargs)
+            return flight.response
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__flights_lock:
+                if self.__flights.get(key) is flight:
+                    del self.__flights[key]
+            flight.done.set()
+
+    def __forget(self, url):
+        """Stops in-flight GETs of url from being shared with later
+        requests, since a write to it is about to change it.
+        """
+        url = url.split('?')[0]
+        with self.__flights_lock:
+            for key in [key for key in self.__flights if key[0] == url]:
+                del self.__flights[key]
+
+    def __send(self, method, url, **kwargs):
+        """Sends a request with the session cookie, when session_auth is
+        on, and with the client's usual authentication otherwise.
+        """
+        if not self.session_auth or 'auth' in kwargs:
+            return self.__route(self.__transmit, method, url, **kwargs)
+        return self.__route(self.__sendInSession, method, url, **kwargs)
+
+    def __sendInSession(self, endpoint, method, url, **kwargs):
+        """Sends a request to endpoint with its session cookie. The first
+        request to each node, and the first one after its session has
+        expired (a 401 status), are sent with Basic auth instead, one
+        thread at a time, so the node issues a new cookie. Until a login
+        to the node succeeds, requests go straight to Basic auth. Retries
+        go to the node that refused the request, since its cookie is only
+        valid there.
+        """
+        logins = self.__sessions.get(endpoint)
+        if logins is None:
+            with self.__auth_lock:
+                logins = self.__sessions.get(endpoint)
+                if logins is None:
+                    return self.__login(endpoint, method, url, **kwargs)
+        response = self.__transmit(endpoint, method, url, **kwargs)
+        if response.status_code != 401 or not self.session_auth:
+            return response
+        with self.__auth_lock:
+            if self.__sessions.get(endpoint) == logins:
+                return self.__login(self.__reacquire(endpoint, url), method,
+                                    url, **kwargs)
+        response = self.__transmit(self.__reacquire(endpoint, url), method,
+                                   url, **kwargs)
+        if response.status_code == 401:
+            with self.__auth_lock:
+                response = self.__login(self.__reacquire(endpoint, url),
+                                        method, url, **kwargs)
+        return response
+
+    def __login(self, endpoint, method, url, **kwargs):
+        """Sends a request to endpoint with Basic auth, keeping the session
+        cookie the node answers with. Servers that don't issue one get
+        Basic auth on every request from then on. Refused credentials (a
+        401 status) aren't counted as a login, and the next request to the
+        node logs in again.
+        """
+        response = self.__transmit(endpoint, method, url, auth=self.cred,
+                                   **kwargs)
+        if response.status_code == 401:
+            self.__sessions.pop(endpoint, None)
+            return response
+        self.logins += 1
+        self.__sessions[endpoint] = self.logins
+        if response.status_code < 400 and not response.cookies:
+            self.session_auth = False
+            self.session.auth = self.cred
+        return response
+
+    def __reacquire(self, endpoint, url):
+        """Takes endpoint again from the cluster's pool, for one more
+        request to the same node.
+        """
+        if endpoint is not None:
+            self.endpoints.acquire(url, node=endpoint)
+        return endpoint
+
+    def __route(self, send, method, url, **kwargs):
+        """Sends a request with send, to one of the cluster's nodes when
+        the client has several. GETs that can't connect to a node are sent
+        again to the next one.
+        """
+        if self.endpoints is None:
+            return send(None, method, url, **kwargs)
+        tries = len(self.endpoints.endpoints) if method.upper() == 'GET' \
+            else 1
+        tried = []
+        while True:
+            endpoint, routed = self.endpoints.acquire(url, exclude=tried)
+            try:
+                return send(endpoint, method, routed, **kwargs)
+            except requests.ConnectionError:
+                tried.append(endpoint)
+                if len(tried) >= tries:
+                    raise
+
+    def __transmit(self, endpoint, method, url, **kwargs):
+        with self.__count_lock:
+            self.request_count += 1
+        limiter = None
+        if self.limiter is not None:
+            limiter = self.limiter.forMethod(method)
+            limiter.acquire()
+        started = time.time()
+        response = error = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            error = e
+            if self.metrics is not None:
+                self.metrics.record(currentOperation(), method, url, None,
+                                    time.time() - started, error=str(e))
+            raise
+        finally:
+            if response is not None:
+                status = response.status_code
+                overloaded, down = status >= 500 or status == 429, \
+                    status >= 500
+            else:
+                overloaded = down = True if error is not None else None
+            if limiter is not None:
+                limiter.release(started, overloaded)
+            if endpoint is not None:
+                self.endpoints.release(endpoint, down)
+        if self.metrics is not None:
+            body = response.request.body
+            if kwargs.get('stream'):
+                received = int(response.headers.get('Content-Length') or 0)
+            else:
+                received = len(response.content)
+            self.metrics.record(currentOperation(), method, url,
+                                response.status_code, time.time() - started,
+                                len(body) if body else 0, received)
+        return self.__decodeOnce(response)
+
+    def __decodeOnce(self, response):
+        """Replaces the response's json() with one that decodes the body
+        with the client's decoder the first time it is called and then
+        returns the same object.
+        """
+        decoded = []
+
+        def parse(**kwargs):
+            if not decoded:
+                decoded.append(self.decoder(response.content))
+            return decoded[0]
+        response.json = parse
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+
+        """Closes the pooled connections held by this client.
+        Usage:
+        >>> client.close()
         """
-        for apps in self.roles.keys():
-            for roles in self.roles.values():
-                if roles:
-                    for role in roles:
-                        my_role = requests.get(self.baseurl
-                                               +'appspaces/'
-                                               +apps+'/roles/'
-                                               +role,
-                                               auth = self.cred)
-                        if my_role.ok:                            
-                            for uri in my_role.json()['workbaskets'].values():
-                                self.queue_urls.append(uri['URI'])                                
-                                self.workbaskets[uri['URI'].split(
-                                    '/')[-1]] = uri['URI']
-                                
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @instrumented
     def getLoggedUserInfo(self):
         
         """Returns a dictionary with logged user information.
@@ -101,8 +643,7 @@ class PEClient(object):
         >>> user_info = client.getLoggedUserInfo()
         """
         
-        self.userinfo = requests.get(self.baseurl+'currentuser',
-                                     auth=self.cred).json()
+        self.userinfo = self.get(self.baseurl+'currentuser').json()
         return self.userinfo                                
 
     
@@ -111,12 +652,53 @@ class PE(object):
     """Creates a PE object. An instance from PEClient must be passed.
     Usage:
     >>> pe = PE(client)
+
+    Step elements are cached, up to step_cache_size of them, together with
+    their ETag. Reading the same step again sends a conditional request,
+    so unchanged steps cost a "304 Not Modified" instead of the full body.
+    Methods that change a task drop its step from the cache.
+    >>> pe = PE(client, step_cache_size=1000)
+    >>> pe.step_cache.stats() -> {'hits': 12, 'misses': 3, ...}
+
+    Each launch made by startWorkflow fetches the workclass definition,
+    which comes with the work object number the server assigned to the
+    new workflow. With generate_wobnums=True, definitions are cached for
+    workclass_ttl seconds instead, and every launch gets a work object
+    number made by the client (a random GUID written as 32 uppercase
+    hexadecimal digits, like the engine's own). This relies on the
+    server accepting any unused number in
+    POST rosters/DefaultRoster/wc/<workflow>/wob/<number>; check that
+    yours does before turning it on. Use invalidateWorkClass() after
+    changing a workflow definition.
+    >>> pe = PE(client, generate_wobnums=True, workclass_ttl=3600)
+
+    Directory service lookups (findUsers, findGroups and the user check
+    done by reassignTask) are cached for directory_ttl seconds. Searches
+    that found nothing are cached for negative_ttl seconds.
+    >>> pe = PE(client, directory_ttl=900, negative_ttl=30)
     """
     
-    def __init__(self, client):
+    def __init__(self, client, step_cache_size=256, workclass_ttl=600,
+                 directory_cache_size=1024, directory_ttl=300,
+                 negative_ttl=60, generate_wobnums=False):
         self.client = client
-        self.apps = client.apps       
+        self.step_cache = LRUCache(step_cache_size)
+        self.generate_wobnums = generate_wobnums
+        self.workclass_cache = LRUCache(256, ttl=workclass_ttl)
+        self.directory_cache = LRUCache(directory_cache_size,
+                                        ttl=directory_ttl)
+        self.negative_ttl = negative_ttl
+        self.count_cache = LRUCache(4096)
+
+    @property
+    def apps(self):
+        return self.client.apps
+
+    @property
+    def metrics(self):
+        return self.client.metrics
         
+    @instrumented
     def getInboxQueue(self):
         
         """Returns the User's Inbox Queue.
@@ -124,73 +706,255 @@ class PE(object):
         >>> inbox = pe.getInboxQueue()
         >>> inbox.get('count') -> Variable with the total tasks in this Queue.
         """        
-        work_basket = requests.get(self.client.baseurl+'queues/'
-                                        +'Inbox'
-                                        +'/workbaskets/'
-                                        +'Inbox',
-                                        auth = self.client.cred)
-        count = requests.get(work_basket.url + '/queueelements/count',
-                             auth = self.client.cred).json()['count']
-        queue = work_basket.json()        
+        work_basket = self.client.get(self.client.baseurl+'queues/'
+                                      +'Inbox'
+                                      +'/workbaskets/'
+                                      +'Inbox')
+        count = self.client.get(work_basket.url
+                                + '/queueelements/count').json()['count']
+        queue = dict(work_basket.json())
         queue['count'] = count
         return queue
     
-    def getQueue(self, work_basket):
+    @instrumented
+    def getQueue(self, work_basket, query_filter=None, subs_vars=None):
         
         """Returns a Queue for a given Workbasket.
         Usage:
         >>> my_queue = pe.getQueue('workbasket_name')
         >>> my_queue.get('count')->Variable with the total tasks in this Queue.
+
+        A queue filter expression can be given in query_filter, with :A, :B,
+        ... standing for the values listed in subs_vars. The filter is
+        applied by the server: count only counts the matching tasks, and
+        getTasks and iterTasks only return them.
+        >>> my_queue = pe.getQueue('workbasket_name',
+        query_filter='F_Subject = :A', subs_vars=['Invoice 42'])
         """                
         
-        queue = requests.get(self.client.baseurl
-                             + self.client.workbaskets.get(work_basket),
-                             auth = self.client.cred)
-        count = requests.get(queue.url + '/queueelements/count',
-                             auth = self.client.cred).json()['count']
-        queue = queue.json()
+        params = _queueQuery(query_filter, subs_vars)
+        queue = self.client.get(self.client.baseurl
+                                + self.client.workbaskets.get(work_basket))
+        count = self.client.get(queue.url + '/queueelements/count',
+                                params=params).json()['count']
+        queue = dict(queue.json())
         queue['count'] = count
+        if params:
+            queue['query'] = params
         return queue
 
-    def getAllTasks(self):
+    @instrumented
+    def getQueueCounts(self, names=None, workers=8, max_age=None):
+
+        """Returns the number of tasks in every Workbasket, or in the
+        given ones, as a QueueCounts tuple with the fields counts (a
+        dictionary of counts by Workbasket name), errors (the errors by
+        name of the Workbaskets that couldn't be counted), cached (how
+        many counts weren't requested) and elapsed (seconds).
+        Only the counts are requested, by up to workers threads.
+        Usage:
+        >>> pe.getQueueCounts().counts -> {'Inbox': 3, 'Invoices': 120}
+        With max_age, counts requested less than max_age seconds before
+        are reused instead of being requested again.
+        >>> snapshot = pe.getQueueCounts(max_age=60)
+        """
+        started = time.time()
+        if names is None:
+            names = sorted(self.client.workbaskets)
+        counts, errors, missing = {}, {}, []
+        for name in names:
+            cached = self.count_cache.get(name) if max_age else None
+            if cached is not None and started - cached[1] <= max_age:
+                counts[name] = cached[0]
+            else:
+                missing.append(name)
+
+        def count(name):
+            try:
+                found = self.client.get(self.client.baseurl
+                                        + self.client.workbaskets[name]
+                                        + '/queueelements/count')
+                found.raise_for_status()
+                return name, found.json()['count'], None
+            except Exception as e:
+                return name, None, e
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, found, error in pool.map(inheritOperation(count),
+                                               missing):
+                if error is not None:
+                    errors[name] = error
+                    continue
+                counts[name] = found
+                self.count_cache.set(name, (found, time.time()))
+        return QueueCounts(counts, errors, len(names) - len(missing),
+                           time.time() - started)
+
+    @instrumented
+    def getAllTasks(self, workers=8, timeout=None, compact=False,
+                    errors=None):
         
         """Returns all tasks from all Queues.
         Usage:
         >>> tasks = pe.getAllTasks()
-        When a Queue has no tasks, a message informing which Queues are empty,
-        will be printed.
+        Queues are fetched in parallel, by up to workers threads, and tasks
+        are returned in the same order as client.queue_urls. A Queue that
+        fails, or that takes longer than timeout seconds to be read (from
+        its first request to the last byte of its tasks), is left out of
+        the result and its error is put in the errors dictionary given, if
+        any, with the workbasket name as key. The errors variable holds the
+        errors of the last call to finish, so threads sharing this PE
+        should pass their own dictionary instead.
+        >>> errors = {}
+        >>> tasks = pe.getAllTasks(workers=16, timeout=10, errors=errors)
+        >>> errors -> {'workbasket_name': Timeout(...)}
+        With compact=True tasks are returned as Task objects, which take
+        much less memory than dictionaries and can be used the same way.
+        >>> tasks = pe.getAllTasks(compact=True)
         """
+        if errors is None:
+            errors = {}
+
+        def fetch(uri):
+            try:
+                return self.__getQueueTasks(uri, timeout, compact)
+            except Exception as e:
+                errors[uri.split('/')[-1]] = e
+                return []
+
         tasks = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for found_tasks in pool.map(inheritOperation(fetch),
+                                        self.client.queue_urls):
+                tasks.extend(found_tasks)
+        self.errors = errors
+        return tasks
+
+    def __getQueueTasks(self, uri, timeout=None, compact=False):
+
+        """Returns the tasks for the workbasket at uri. With timeout, both
+        requests together, bodies included, must be done within timeout
+        seconds, or requests.Timeout is raised.
+        """
+        if timeout is None:
+            queue = self.client.get(self.client.baseurl + uri)
+            queue.raise_for_status()
+            work_items = self.client.get(self.client.baseurl
+                                         + queue.json()['queueElements'])
+            work_items.raise_for_status()
+            return _tasks(work_items.json().get('queueElements') or [],
+                          compact)
+        deadline = time.time() + timeout
+        queue = self.client.decoder(self.__readBefore(
+            self.client.baseurl + uri, deadline))
+        elements = self.client.decoder(self.__readBefore(
+            self.client.baseurl + queue['queueElements'], deadline))
+        return _tasks(elements.get('queueElements') or [], compact)
+
+    def __readBefore(self, url, deadline):
+        """GETs url and returns its body, raising requests.Timeout if it
+        isn't fully received by deadline (a time.time() value).
+        """
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise requests.Timeout('Deadline passed before GET %s' % url)
+        response = self.client.get(url, timeout=remaining, stream=True)
+        try:
+            response.raise_for_status()
+            chunks = []
+            for chunk in response.iter_content(65536):
+                chunks.append(chunk)
+                if time.time() > deadline:
+                    raise requests.Timeout('Deadline passed reading %s'
+                                           % url)
+            return b''.join(chunks)
+        finally:
+            response.close()
+
+    @instrumented
+    def iterAllTasks(self, page_size=100, compact=False):
+
+        """Yields every task from every Queue, one page of page_size
+        elements at a time, so memory use doesn't grow with the amount of
+        tasks.
+        Usage:
+        >>> for task in pe.iterAllTasks():
+        ...     print task['workObjectNumber']
+        """
         for uri in self.client.queue_urls:
-            queue = requests.get(self.client.baseurl + uri,
-                                 auth = self.client.cred)
-            found_tasks = self.getTasks(queue.json())
-            if found_tasks:
-                tasks.append(found_tasks)
-        return [tsk for task in tasks for tsk in task]
+            queue = self.client.get(self.client.baseurl + uri).json()
+            for task in self.iterTasks(queue, page_size, compact):
+                yield task
 
-    def getTasks(self, queue):
+    @instrumented
+    def getTasks(self, queue, compact=False, query_filter=None,
+                 subs_vars=None, order_by=None, descending=False, limit=None):
         
         """Returns a dictionary with all tasks for the given queue.
         A queue object is required.
         Usage:
         >>> tasks = pe.getTasks(my_queue)
+        >>> tasks = pe.getTasks(my_queue, compact=True) -> Task objects
+
+        Filtering, sorting and limiting are done by the server, so only
+        the wanted tasks are transferred. query_filter and subs_vars work
+        as in getQueue, and query_filter replaces the queue's own filter
+        together with its subs_vars. order_by names the field to sort on
+        and limit caps the number of tasks.
+        >>> tasks = pe.getTasks(my_queue, query_filter='F_Subject = :A',
+        subs_vars=['Invoice 42'], order_by='F_WobNum', limit=50)
 
         """
-        work_items = requests.get(self.client.baseurl
-                                  + queue.get('queueElements'),
-                                  auth = self.client.cred)
-        if not work_items.json():
+        params = dict(queue.get('query') or {})
+        if query_filter:
+            params.pop('filter', None)
+            params.pop('subsVars', None)
+        if order_by:
+            params.pop('descending', None)
+        params.update(_queueQuery(query_filter, subs_vars, order_by,
+                                  descending, limit))
+        work_items = self.client.get(self.client.baseurl
+                                     + queue.get('queueElements'),
+                                     params=params).json()
+        if not work_items:
             print ("'%s' queue is empty!"%queue['name'])
         else:
-            return work_items.json()['queueElements']
+            return _tasks(work_items['queueElements'], compact)
+
+    @instrumented
+    def iterTasks(self, queue, page_size=100, compact=False):
 
+        """Yields the tasks from the given queue. Queue elements are
+        requested page_size at a time, using the REST API's pageSize and
+        lastRecord parameters, and the next page is only requested once the
+        current one has been consumed. Pages go on while the server sends
+        a lastRecord, even when it returns fewer than page_size tasks.
+        Usage:
+        >>> for task in pe.iterTasks(my_queue, page_size=500):
+        ...     pe.endTask(task)
+        With compact=True, Task objects are yielded instead of dictionaries.
+        A filter given to getQueue is applied here too.
+        """
+        params = dict(queue.get('query') or {})
+        params['pageSize'] = page_size
+        while True:
+            page = self.client.get(self.client.baseurl
+                                   + queue.get('queueElements'),
+                                   params=params).json()
+            elements = page.get('queueElements') or []
+            for task in _tasks(elements, compact):
+                yield task
+            if not page.get('lastRecord') or not elements:
+                break
+            params['lastRecord'] = page['lastRecord']
+
+    @instrumented
     def getMilestones(self, task):
-        milestone = requests.get(self.client.baseurl
-                                 + task['milestones'],
-                                 auth = self.client.cred)
+        milestone = self.client.get(self.client.baseurl
+                                    + task['milestones'])
         return milestone.json()
 
+    @instrumented
     def lockTask(self, task):
         
         """Receives a task dictionary, obtainned with getTasks() method,
@@ -199,18 +963,28 @@ class PE(object):
         >>> pe.lockTask(task)
         """
         
-        locked = requests.get(self.client.baseurl
-                              +task['stepElement'],
-                              auth = self.client.cred)
-        eTag = locked.headers['ETag']
-        locked = requests.put(self.client.baseurl
-                              + task['stepElement'],
-                              auth = self.client.cred,
-                              params={'action':'lock',
-                                      'If-Match':eTag}
-                              )        
+        return self.__lock(task)[0]
 
-    def saveAndUnlockTask(self, task, comment = None):
+    def __lock(self, task):
+        """Locks the task using the ETag it already carries. The step is
+        only read again, to get its current ETag, when the server answers
+        "412 Precondition Failed" because the task changed since it was
+        listed. Returns the lock response and the ETag it was sent with.
+        """
+        url = self.client.baseurl + task['stepElement']
+        eTag = task.get('ETag')
+        locked = self.client.put(url, params={'action':'lock',
+                                              'If-Match':eTag})
+        if locked.status_code == 412:
+            self.step_cache.invalidate(url)
+            url, eTag, step = self.__getStepElement(task)
+            locked = self.client.put(url, params={'action':'lock',
+                                                  'If-Match':eTag})
+        self.step_cache.invalidate(url)
+        return locked, eTag
+
+    @instrumented
+    def saveAndUnlockTask(self, task, comment = None, refresh = True):
         
         """Receives a task dictionary obtainned with getTasks() or getAllTasks(),
         method, unlocks the task and saves it. Optionally, is possible to pass
@@ -218,41 +992,34 @@ class PE(object):
         Usage:
         >>> task = pe.saveAndUnlockTask(task) or
         >>> task = pe.saveAndUnlockTask(task, "Comment added!!!")            
+        When the updated task isn't needed, pass refresh=False and the
+        given task will be returned as is, without looking it up again.
         """
         
         etag = task['ETag']
-        stepEl =  requests.get(self.client.baseurl
-                               +task['stepElement'],
-                               auth = self.client.cred)
+        url = self.client.baseurl + task['stepElement']
         try:
             if comment:
-                updatedJson = stepEl.json()
+                url, step_etag, updatedJson = self.__getStepElement(task)
                 updatedJson['systemProperties']['comment'] = comment
                 self.lockTask(task)
-                unlocked = requests.put(stepEl.url, auth = self.client.cred,
-                                        params = {'action':'saveAndUnlock',
-                                                  'If-Match':etag},
-                                        json = updatedJson)            
+                unlocked = self.client.put(url,
+                                           params = {'action':'saveAndUnlock',
+                                                     'If-Match':etag},
+                                           json = updatedJson)            
             else: 
-                unlocked = requests.put(self.client.baseurl
-                                        + task['stepElement'],
-                                        auth = self.client.cred,
-                                        params={'action':'saveAndUnlock',
-                                                'If-Match':etag})
-            
-
-            for k, v in self.client.workbaskets.items():
-                if task.get('queueName') in v:
-                    queue = self.getQueue(v.split('/')[-1])
-                    tasks = self.getTasks(queue)
-                    for newtask in tasks:
-                        if newtask['workObjectNumber'] == task['workObjectNumber']:
-                            task = newtask
-                            break
+                unlocked = self.client.put(url,
+                                           params={'action':'saveAndUnlock',
+                                                   'If-Match':etag})
+            self.step_cache.invalidate(url)
+            if refresh:
+                task = self.__refreshTask(task, unlocked)
         except Exception as e:
+            self.step_cache.invalidate(url)
             self.abort(task)
         return task
     
+    @instrumented
     def reassignTask(self, task, destination, comment = None):
         
         """This method receives a task and reassigns it to a
@@ -264,28 +1031,26 @@ class PE(object):
         >>> pe.reassignTask(task, 'p8_user') or
         >>> pe.reassignTask(task, 'anyuser', "Hey check this out")        
         """
-        found_user = self.getUser(destination)
-
-        if destination in found_user:        
+        if self.__isUser(destination):        
             if comment:            
                 self.lockTask(task)
                 self.saveAndUnlockTask(task, comment)
                 
-            task = requests.get(self.client.baseurl
-                                + task['stepElement'],
-                                auth = self.client.cred)
-            etag = task.headers['ETag']
-
-            if (task.json()['systemProperties']['canReassign']):
-                reassigned = requests.put(task.url, auth=self.client.cred,
-                                       params={'action':'reassign',
-                                               'participant':destination,
-                                               'If-Match':etag})                               
+            url, etag, step = self.__getStepElement(task)
+
+            if (step['systemProperties']['canReassign']):
+                reassigned = self.client.put(url,
+                                             params={'action':'reassign',
+                                                     'participant':destination,
+                                                     'If-Match':etag})                               
+                self.step_cache.invalidate(url)
+                return reassigned
             else:
                 return "Task can't be reassigned"
         else:
             return "User '%s' not found in Directory Service"%destination
             
+    @instrumented
     def returnToSource(self, task, comment=None):
         
         """Given a task, this method will returns it to a previous Workbasket.
@@ -302,19 +1067,18 @@ class PE(object):
             self.lockTask(task)
             self.saveAndUnlockTask(task, comment)
             
-        task = requests.get(self.client.baseurl
-                            + task['stepElement'],
-                            auth = self.client.cred)
-
-        etag = task.headers['ETag']
+        url, etag, step = self.__getStepElement(task)
         
-        if task.json()['systemProperties']['canReturnToSource']:
-            returned = requests.put(task.url, auth=self.client.cred,
-                                   params={'action':'returnToSource',
-                                           'If-Match':etag})
+        if step['systemProperties']['canReturnToSource']:
+            returned = self.client.put(url,
+                                       params={'action':'returnToSource',
+                                               'If-Match':etag})
+            self.step_cache.invalidate(url)
+            return returned
         else:
             return "Returning to source is not available for this task"
         
+    @instrumented
     def getComment(self, task):
         
         """Receives a task and if there is comment, it will be printed.
@@ -322,10 +1086,8 @@ class PE(object):
         >>> comment = pe.getComment(task)
         """
         
-        stepelements = requests.get(self.client.baseurl
-                                    + task['stepElement'],
-                                    auth = self.client.cred)
-        comment = stepelements.json()['systemProperties']['comment']
+        url, etag, stepelements = self.__getStepElement(task)
+        comment = stepelements['systemProperties']['comment']
 
         if comment:            
             return comment
@@ -340,6 +1102,7 @@ class PE(object):
         self.__iterDictionary(task)        
         return self.info
 
+    @instrumented
     def getResponses(self, task):
         """Given a task, this method will return the available responses
         for the current step in the task. Responses are options set in
@@ -347,22 +1110,44 @@ class PE(object):
         Usage:
         >>> responses = pe.getResponses(task)
         """
-        step = requests.get(self.client.baseurl
-                                    + task['stepElement'],
-                                    auth = self.client.cred).json()
+        url, etag, step = self.__getStepElement(task)
         responses = step['systemProperties']['responses']
         return responses
     
+    @instrumented
     def getStep(self, task):
         """Given a task, this method will return the current step. A task
         is composed by steps. Some step might require data to be provided.
         Usage:
         >>> current_step = pe.getStep(task)
         """
-        step = requests.get(self.client.baseurl+task['stepElement'],
-                            auth = self.client.cred).json()
+        url, etag, step = self.__getStepElement(task)
         return step
+
+    def __getStepElement(self, task):
+        """Returns the URL, ETag and content of the task's step element.
+        Cached step elements are revalidated with If-None-Match, and only
+        downloaded again when the server says they have changed. Errors
+        from the server are raised as requests.HTTPError.
+        """
+        url = self.client.baseurl + task['stepElement']
+        cached = self.step_cache.peek(url)
+        headers = {}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        step = self.client.get(url, headers=headers)
+        if cached and step.status_code == 304:
+            self.step_cache.record(True)
+            etag, content = cached
+        else:
+            self.step_cache.record(False)
+            step.raise_for_status()
+            etag, content = step.headers.get('ETag'), step.content
+            if etag:
+                self.step_cache.set(url, (etag, content))
+        return url, etag, self.client.decoder(content)
     
+    @instrumented
     def getStepInfo(self, task):
         """Given a task, this method will return all the available options
         that are possible to interact with, within the current step.
@@ -375,8 +1160,7 @@ class PE(object):
         'selectedResponse': [u'Approve', u'Reject']}
         """
         step_info = {}
-        step = requests.get(self.client.baseurl+task['stepElement'],
-                            auth = self.client.cred).json()
+        url, etag, step = self.__getStepElement(task)
         if step.get('systemProperties').get('responses'):
             step_info['selectedResponse'] = step['systemProperties']['responses']
         if step.get('workFlowGroups'):
@@ -391,7 +1175,8 @@ class PE(object):
 
         return step_info   
     
-    def updateTask(self, task, **kwargs):
+    @instrumented
+    def updateTask(self, task, refresh=None, **kwargs):
         """Some steps might require some data to be filled in, so the task can
         go through other steps to it's end. Usually it is possible to:
             - Add users to a workflow group,
@@ -406,17 +1191,32 @@ class PE(object):
         workflow provided by IBM:
         Usage:
         >>> task = pe.updateTask(task, selectedResponse='Approve')
+        When the updated task isn't needed, pass refresh=False and the
+        given task will be returned as is, without looking it up again.
+        If the step has a data field named refresh, passing refresh raises
+        a ValueError, since it isn't clear which one was meant.
+        """
+        options = ('refresh',) if refresh is not None else ()
+        return self.__updateTask(task, refresh is not False, options, kwargs)
+
+    def __updateTask(self, task, refresh, options, kwargs):
+        """Does the work of updateTask(). options names the arguments
+        given to the calling method which aren't data fields, and a
+        ValueError is raised when the step has data fields with the same
+        names.
         """
         data_types = {1:type(int()),
                       2:type(str()),
                       16:type(datetime.today())}
         
         etag = task['ETag']       
-        step = requests.get(self.client.baseurl+task['stepElement'],
-                            auth = self.client.cred)
-        url = step.url
-        step = step.json()
+        url, step_etag, step = self.__getStepElement(task)
         message = "Task updated"
+        clashes = sorted(set(options) & set(step.get('dataFields') or {}))
+        if clashes:
+            raise ValueError("Can't tell the data fields of this step "
+                             "from the arguments with the same names: %s"
+                             % ', '.join(clashes))
         
         for field in step.get('dataFields'):            
             if field in kwargs.keys():
@@ -432,10 +1232,10 @@ class PE(object):
         
         self.lockTask(task)
         
-        unlocked = requests.put(url, auth = self.client.cred,
-                                        params = {'action':'saveAndUnlock',
+        unlocked = self.client.put(url, params = {'action':'saveAndUnlock',
                                                   'If-Match':etag},
-                                        json = step)        
+                                   json = step)        
+        self.step_cache.invalidate(url)
         try:
             unlocked.raise_for_status()
             
@@ -443,17 +1243,38 @@ class PE(object):
             self.abort(task)
             raise RuntimeError(str(e)+'\n'+unlocked.text)
             
-        
+        if refresh:
+            task = self.__refreshTask(task, unlocked)
+        return task
+
+    def __refreshTask(self, task, response=None):
+        """Returns the task as it is after being saved. When the save
+        response carries the new ETag, a copy of the task with that ETag is
+        returned without any other request. Otherwise only this task's
+        queue element is requested, filtered by its work object number.
+        """
+        if response is not None and response.ok \
+           and response.headers.get('ETag'):
+            task = task.copy()
+            task['ETag'] = response.headers['ETag']
+            return task
         for k, v in self.client.workbaskets.items():
             if task.get('queueName') in v:
-                queue = self.getQueue(v.split('/')[-1])
-                tasks = self.getTasks(queue)
-                for newtask in tasks:
-                    if newtask['workObjectNumber'] == task['workObjectNumber']:
-                        task = newtask
-                        break
+                found = self.client.get(self.client.baseurl + v
+                                        + '/queueelements',
+                                        params={'filter':'F_WobNum = :A',
+                                                'subsVars':json.dumps(
+                                                    [task['workObjectNumber']]),
+                                                'pageSize':1})
+                if found.ok:
+                    for newtask in found.json().get('queueElements') or []:
+                        if newtask['workObjectNumber'] == task[
+                                'workObjectNumber']:
+                            return (Task(newtask) if isinstance(task, Task)
+                                    else newtask)
         return task
         
+    @instrumented
     def endTask(self, task, comment=None):        
         """Receives a task and finishes it, finishing the workflow itself or
         moving to the next step in the task. Is also possible to create a
@@ -463,23 +1284,72 @@ class PE(object):
         >>> pe.endTask(task, u'Completed the task!')
         
         """
-        params = {'action':'dispatch'}
-        step = self.getStep(task)
-        if step.get('systemProperties').get('responses')\
-           and not step.get('systemProperties').get('selectedResponse'):
-            return "This task needs to be updated. Check the updateTask method."
+        return self.completeTask(task, comment)
+
+    @instrumented
+    def completeTask(self, task, comment=None, response=None, locked=None,
+                     **fields):
+        """Finishes a task with two requests: the task is locked with the
+        ETag it already carries, and then dispatched with the comment, the
+        selected response and the data fields all in the same request. The
+        step is only read again when the task changed since it was listed.
+        Returns the dispatch response (or the lock response, when the task
+        couldn't be locked). When the step requires a response and none
+        was given or saved before, the task is unlocked and a message is
+        returned instead.
+        Usage:
+        >>> pe.completeTask(task) #or
+        >>> pe.completeTask(task, u'Approved!', response='Approve',
+        ICN_Instructions='Done')
+        When the task is already locked, pass the response from lockTask
+        as locked and only the dispatch is requested.
+        >>> pe.completeTask(task, locked=pe.lockTask(task))
+        """
+        if locked is None:
+            locked, etag = self.__lock(task)
         else:
-            params['selectedResponse'] = 1           
-        
+            etag = task.get('ETag')
+        if not locked.ok:
+            return locked
+        etag = locked.headers.get('ETag') or etag
+        unlocked = task.copy()
+        unlocked['ETag'] = etag
+        try:
+            step = locked.json()
+        except ValueError:
+            step = None
+        if not step or 'systemProperties' not in step:
+            url, step_etag, step = self.__getStepElement(task)
+        properties = step['systemProperties']
+
+        if response is not None:
+            if response not in (properties.get('responses') or []):
+                self.abort(unlocked)
+                raise ValueError("Response '%s' isn't available for this "
+                                 "task" % response)
+            properties['selectedResponse'] = response
+        if properties.get('responses') \
+           and not properties.get('selectedResponse'):
+            self.abort(unlocked)
+            return "This task needs to be updated. Check the updateTask method."
         if comment:
-            task = self.saveAndUnlockTask(task, comment)
-     
-        lock = self.lockTask(task)
-        params['If-Match'] = task['ETag']
-        dispatched = requests.put(self.client.baseurl + task['stepElement'],
-                                  auth = self.client.cred,
-                                  params=params)        
+            properties['comment'] = comment
+        for field, value in fields.items():
+            data_field = (step.get('dataFields') or {}).get(field)
+            if data_field and data_field['mode'] != 1:
+                data_field['value'] = value
+                data_field['modified'] = True
+
+        url = self.client.baseurl + task['stepElement']
+        dispatched = self.client.put(url, params={'action':'dispatch',
+                                                  'If-Match':etag},
+                                     json=step)
+        self.step_cache.invalidate(url)
+        if not dispatched.ok:
+            self.abort(unlocked)
+        return dispatched
             
+    @instrumented
     def abort(self, task):
         
         """Receives a task, and unlocks it without saving any changes.
@@ -488,11 +1358,100 @@ class PE(object):
         """
         
         eTag = task['ETag']
-        locked = requests.put(self.client.baseurl+task['stepElement'],
-                              auth=self.client.cred,
-                              params={'action':'abort',
-                                      'If-Match': eTag})
+        locked = self.client.put(self.client.baseurl+task['stepElement'],
+                                 params={'action':'abort',
+                                         'If-Match': eTag})
+        self.step_cache.invalidate(self.client.baseurl+task['stepElement'])
+        return locked
         
+    @instrumented
+    def bulkEnd(self, tasks, comment=None, workers=8, fail_fast=False):
+        """Finishes many tasks at once, like calling endTask() for each one.
+        Up to workers tasks are handled at the same time. A list of
+        TaskResult (task, ok, status, error, elapsed, result) is returned,
+        in the same order as tasks. With fail_fast=True, tasks that haven't
+        started when the first failure happens are skipped.
+        Usage:
+        >>> results = pe.bulkEnd(tasks, u'Done', workers=16)
+        >>> failed = [r for r in results if not r.ok]
+        """
+        return self.__bulk(tasks, lambda task: self.endTask(task, comment),
+                           workers, fail_fast)
+
+    @instrumented
+    def bulkReassign(self, tasks, destination, comment=None, workers=8,
+                     fail_fast=False):
+        """Reassigns many tasks to destination at once, like calling
+        reassignTask() for each one. Returns a list of TaskResult, see
+        bulkEnd().
+        Usage:
+        >>> results = pe.bulkReassign(tasks, 'p8_user')
+        """
+        return self.__bulk(tasks,
+                           lambda task: self.reassignTask(task, destination,
+                                                          comment),
+                           workers, fail_fast)
+
+    @instrumented
+    def bulkUpdate(self, tasks, workers=None, fail_fast=None, **kwargs):
+        """Updates many tasks with the same data fields and response, like
+        calling updateTask() for each one. The result of each TaskResult is
+        the updated task. Returns a list of TaskResult, see bulkEnd().
+        Tasks whose step has data fields named like the workers, fail_fast
+        or refresh arguments given fail with a ValueError, as in
+        updateTask().
+        Usage:
+        >>> results = pe.bulkUpdate(tasks, selectedResponse='Approve')
+        """
+        options = [name for name, value in (('workers', workers),
+                                            ('fail_fast', fail_fast))
+                   if value is not None]
+        refresh = kwargs.pop('refresh', None)
+        if refresh is not None:
+            options.append('refresh')
+        return self.__bulk(tasks,
+                           lambda task: self.__updateTask(
+                               task, refresh is not False, options, kwargs),
+                           8 if workers is None else workers,
+                           bool(fail_fast))
+
+    def __bulk(self, tasks, action, workers, fail_fast):
+        """Runs action for every task on a thread pool and returns one
+        TaskResult for each task, in order.
+        """
+        tasks = list(tasks)
+        failed = threading.Event()
+
+        def run(task):
+            if fail_fast and failed.is_set():
+                return TaskResult(task, False, None, 'Skipped', 0.0, None)
+            started = time.time()
+            status = None
+            try:
+                result = action(task)
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                if response is not None:
+                    status = response.status_code
+                failed.set()
+                return TaskResult(task, False, status, str(e),
+                                  time.time() - started, None)
+            error = None
+            if isinstance(result, requests.Response):
+                status = result.status_code
+                if not result.ok:
+                    error = result.text
+            elif isinstance(result, basestring):
+                error = result
+            if error is not None:
+                failed.set()
+            return TaskResult(task, error is None, status, error,
+                              time.time() - started, result)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(inheritOperation(run), tasks))
+
+    @instrumented
     def getAttachmentsInfo(self, task):        
         """Receives a task and prints information about files that has been
         attached to the Workflow.
@@ -500,8 +1459,7 @@ class PE(object):
         >>> pe.getAttachmentsInfo(task)
         """
         self.info = {}
-        task = requests.get(self.client.baseurl + task['stepElement'],
-                            auth = self.client.cred).json()
+        url, etag, task = self.__getStepElement(task)
         
         if task.get('attachments'):
             self.__iterDictionary(task['attachments'])            
@@ -518,6 +1476,7 @@ class PE(object):
             else:              
               self.info[key.capitalize()] = value
 
+    @instrumented
     def getUser(self, search_string):
         """Receives a string and looks for it in directory service. If the
         string search isn't found, the message "User not Found" will be
@@ -527,39 +1486,101 @@ class PE(object):
         >>> users = pe.getUser('user_name')
         """
         
-        users = []
-        user = requests.get(self.client.baseurl+'users',
-                            auth=self.client.cred,
-                            params={'searchPattern':search_string,
-                                    'searchType':4, 'limit':50})
-        if user.json().get('users'):            
-            for usr in user.json()['users']:
-                users.append(usr['displayName'])
-        else:
+        users = [usr['displayName'] for usr in self.findUsers(search_string)]
+        if not users:
             return "User not Found"
         return users
     
+    @instrumented
     def getGroup(self, search_string):
         """Receives a string and looks for it in directory service. If the
         string search isn't found, the message "Group not Found" will be
-        returned, otherwise a list with all matching cases, limited to 50
+        returned, otherwise a list with all matching cases, limited to 3000
         results will be returned.
         Usage:
         >>> users = pe.getGroup('group_name')
         """        
         
-        groups = []
-        group = requests.get(self.client.baseurl+'groups',
-                            auth=self.client.cred,
-                            params={'searchPattern':search_string,
-                                    'searchType':4, 'limit':3000})
-        if group.json().get('groups'):
-            for grp in group.json()['groups']:
-                groups.append(grp['displayName'])
-        else:
+        groups = [grp['displayName']
+                  for grp in self.findGroups(search_string, limit=3000)]
+        if not groups:
             return "Group not Found"
         return groups
+
+    @instrumented
+    def findUsers(self, search_string, limit=50):
+        """Looks for search_string in directory service and returns a list
+        with the matching users, as dictionaries with the 'name',
+        'displayName' and 'email' keys. An empty list is returned when no
+        user is found. Results are cached.
+        Usage:
+        >>> pe.findUsers('john') -> [{'name': 'john', 'displayName': ...}]
+        """
+        return self.__searchDirectory('users', search_string, limit)
+
+    @instrumented
+    def findGroups(self, search_string, limit=50):
+        """Same as findUsers, for groups.
+        Usage:
+        >>> pe.findGroups('approvers') -> [{'name': 'approvers', ...}]
+        """
+        return self.__searchDirectory('groups', search_string, limit)
+
+    @instrumented
+    def warmDirectory(self, users=(), groups=(), workers=8):
+        """Looks up a list of known users and groups at once, so later
+        reassignments and searches for them are served from the cache.
+        Returns the names that weren't found in directory service.
+        Usage:
+        >>> pe.warmDirectory(users=['user1', 'user2'], groups=['approvers'])
+        -> []
+        """
+        lookups = ([(self.__isUser, name) for name in users]
+                   + [(self.__isGroup, name) for name in groups])
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            found = list(pool.map(inheritOperation(
+                lambda lookup: lookup[0](lookup[1])), lookups))
+        return [name for (_, name), ok in zip(lookups, found) if not ok]
+
+    def invalidateDirectory(self, search_string=None):
+        """Drops the cached user and group searches for search_string, or
+        every cached search when no string is given.
+        """
+        if search_string is None:
+            self.directory_cache.clear()
+        else:
+            self.directory_cache.invalidate(('users', search_string))
+            self.directory_cache.invalidate(('groups', search_string))
+
+    def __isUser(self, name):
+        return any(name in (usr.get('name'), usr.get('displayName'))
+                   for usr in self.findUsers(name))
+
+    def __isGroup(self, name):
+        return any(name in (grp.get('name'), grp.get('displayName'))
+                   for grp in self.findGroups(name))
+
+    def __searchDirectory(self, kind, search_string, limit):
+        """Searches users or groups (kind) in directory service. The
+        results are cached along with the limit used, so a later search
+        with a lower limit is served from the same entry.
+        """
+        key = (kind, search_string)
+        cached = self.directory_cache.get(key)
+        if cached is not None:
+            cached_limit, found = cached
+            if limit <= cached_limit or len(found) < cached_limit:
+                return list(found[:limit])
+        response = self.client.get(self.client.baseurl+kind,
+                                   params={'searchPattern':search_string,
+                                           'searchType':4, 'limit':limit})
+        response.raise_for_status()
+        found = response.json().get(kind) or []
+        self.directory_cache.set(key, (limit, found),
+                                 ttl=None if found else self.negative_ttl)
+        return list(found)
         
+    @instrumented
     def startWorkflow(self, **kwargs):        
         """Starting a new workflow is kind of a complex process,
         since the previously created workflow will determine with data must
@@ -644,92 +1665,208 @@ class PE(object):
         subject = 'New Document For review')
 
         """
-        self.kwargs = kwargs
         wf_name = kwargs.get('wf_name')        
         
         if wf_name not in self.client.workflow_classes:
             return "There's no wf_name key on dictionary or the WorkFlow name\
  doesn't exist."
-        work_class = requests.get(self.client.baseurl
-                                 + self.client.workflow_classes[wf_name]['URI'],
-                                  params={'POE':'1'}, auth=self.client.cred)        
-        new_data = work_class.json()
-        
-        if len(self.kwargs.keys()) <= 1:
-            work_class = self.__showAvailableWorkClassOpt(new_data)
-        new_data = self.__createNewDataForLaunch(new_data)        
-        wobnum = new_data['systemProperties']['workObjectNumber']            
-
-        if len(self.kwargs.keys()) > 1:
-            started = requests.post(self.client.baseurl
-                                    + 'rosters/DefaultRoster/wc/'
-                                    + wf_name+'/wob/'
-                                    + wobnum, auth=self.client.cred,
-                                    json=new_data, params={'POE':'1'})
-            started.raise_for_status()
-            
-            return started.text.split('\\')[-1].strip('/').strip('}')[:-1]
-        return work_class
+        new_data = self.__getWorkClass(wf_name)
+        
+        if len(kwargs.keys()) <= 1:
+            return _workClassOptions(new_data)
+        return self.__launch(wf_name, new_data, kwargs)
+
+    @instrumented
+    def startWorkflows(self, wf_name, rows, workers=8):
+        """Launches one workflow per row, 'rows' being any iterable of
+        dictionaries with the same arguments startWorkflow takes (without
+        'wf_name'). Rows are read as they are needed and launched
+        concurrently, so a generator reading a large feed is fine.
 
-    def __showAvailableWorkClassOpt(self, work_class):
-        required_data = {}
-        """Prints some fields that might be required to be setting
-        before sending a Workflow.
+        Yields one LaunchResult(row, ok, wobnum, error, elapsed) per row, in
+        completion order, as soon as each launch finishes. A failed launch
+        doesn't stop the others.
+        Usage:
+        >>> rows = ({'Approvers': user} for user in users)
+        >>> for result in pe.startWorkflows('ICNSequentialDocumentApproval',
+        rows, workers=16):
+        ...     print(result.wobnum if result.ok else result.error)
         """
-        if work_class['dataFields'].keys():
-            print ("To Create this Workflow, you'll probably need to provide\
- below data:")
-            required_data[
-                'Available Data Fields:'] = work_class['dataFields'].keys()
-            print ('\n').join(work_class['dataFields'].keys())+'\n'
-            
-        if work_class['workflowGroups'].keys():
-            required_data['Workflow Groups:'
-                          ] = work_class['workflowGroups'].keys()
-            print("\nGroups to be populated with users:")        
-            print ('\n').join(work_class['workflowGroups'].keys())+'\n'
-
-        if work_class['attachments']:
-            required_data['Attachments:'] = work_class['attachments'].keys()
-            print('\nAvailable Attachment Fields:')
-            print ('\n').join(work_class['attachments'].keys())+'\n'
-
-        return required_data
-
-    def __createNewDataForLaunch(self, new_data):
-        """Adresses the provided data when calling startWorkflow's method to a
-        dictionary to be passed when creating the workflow.
-        """
-        if new_data['workflowGroups'].keys():            
-            for group in new_data['workflowGroups'].keys():
-                if self.kwargs.get(group):
-                    new_data['workflowGroups'][group][
-                        'value'] = self.kwargs.get(group).split(', ')
-                    
-        if new_data['dataFields'].keys():            
-            for data_field in new_data['dataFields'].keys():
-                if self.kwargs.get(data_field):
-                    new_data['dataFields'][data_field][
-                        'value'] = self.kwargs.get(data_field)
-
-        subject = self.kwargs.get('subject')
-        if subject:
-            new_data['systemProperties']['subject'] = subject
-
-        if new_data['attachments']:
-            for attachment in new_data['attachments'].keys():
-                if self.kwargs.get(
-                    attachment) and self.kwargs.get('object_store'):
-                    
-                    d_id = self.kwargs.get(attachment)
-                    object_store = self.kwargs.get('object_store')
-                    document = {u'title':'Attachment',
-                                u'libraryType':3,
-                                u'libraryName':object_store,
-                                u'vsId':d_id,
-                                u'version':d_id,
-                                u'type':3,
-                                u'desc':u''}                    
-                    new_data['attachments'][attachment][
-                        'value'] = document
+        if wf_name not in self.client.workflow_classes:
+            raise KeyError("WorkFlow name doesn't exist: %s" % wf_name)
+
+        def run(row):
+            start = time.time()
+            try:
+                wobnum = self.__launch(wf_name, self.__getWorkClass(wf_name),
+                                       row)
+                return LaunchResult(row, True, wobnum, None,
+                                    time.time() - start)
+            except Exception as e:
+                return LaunchResult(row, False, None, str(e),
+                                    time.time() - start)
+
+        if self.generate_wobnums:
+            self.__cachedWorkClass(wf_name)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for row in rows:
+                pending.add(pool.submit(inheritOperation(run), row))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def invalidateWorkClass(self, wf_name=None):
+        """Drops the cached definition of wf_name, or of every workclass
+        when no name is given.
+        """
+        if wf_name is None:
+            self.workclass_cache.clear()
+        else:
+            self.workclass_cache.invalidate(wf_name)
+
+    def __getWorkClass(self, wf_name):
+        """Returns a fresh copy of the workclass definition, ready to be
+        filled and launched. Unless generate_wobnums is on, it is fetched
+        for every launch, so the server gives each launch its own work
+        object number. Otherwise the definition is served from the cache,
+        and each copy gets a work object number made here, since one can
+        be used by a single launch only.
+        """
+        if not self.generate_wobnums:
+            return self.client.decoder(self.__fetchWorkClass(wf_name))
+        new_data = self.client.decoder(self.__cachedWorkClass(wf_name))
+        new_data['systemProperties'][
+            'workObjectNumber'] = uuid.uuid4().hex.upper()
         return new_data
+
+    def __cachedWorkClass(self, wf_name):
+        """Returns the workclass definition's body, from the cache when
+        possible.
+        """
+        content = self.workclass_cache.get(wf_name)
+        if content is None:
+            content = self.__fetchWorkClass(wf_name)
+            self.workclass_cache.set(wf_name, content)
+        return content
+
+    def __fetchWorkClass(self, wf_name):
+        work_class = self.client.get(self.client.baseurl
+                                     + self.client.workflow_classes[
+                                         wf_name]['URI'],
+                                     params={'POE':'1'})
+        work_class.raise_for_status()
+        return work_class.content
+
+    def __launch(self, wf_name, new_data, options):
+        """POSTs the workclass definition filled with options and returns
+        the new workflow number.
+        """
+        new_data = _launchData(new_data, options)
+        wobnum = new_data['systemProperties']['workObjectNumber']
+        started = self.client.post(self.client.baseurl
+                                   + 'rosters/DefaultRoster/wc/'
+                                   + wf_name+'/wob/'
+                                   + wobnum,
+                                   json=new_data, params={'POE':'1'})
+        started.raise_for_status()
+        
+        return started.text.split('\\')[-1].strip('/').strip('}')[:-1]
+
+
+def _queueQuery(query_filter=None, subs_vars=None, order_by=None,
+                descending=False, limit=None):
+    """Returns the REST API's queue query parameters for the filter, sort
+    and limit arguments taken by getQueue and getTasks.
+    """
+    params = {}
+    if query_filter:
+        params['filter'] = query_filter
+        if subs_vars is not None:
+            if not isinstance(subs_vars, (list, tuple)):
+                subs_vars = [subs_vars]
+            params['subsVars'] = json.dumps(list(subs_vars))
+    if order_by:
+        params['orderBy'] = order_by
+        if descending:
+            params['descending'] = 'true'
+    if limit:
+        params['pageSize'] = limit
+    return params
+
+
+def _tasks(elements, compact):
+    """Returns the queue elements as Task objects when compact is True."""
+    if compact:
+        return [Task(element) for element in elements]
+    return elements
+
+
+def _workClassOptions(work_class):
+    """Prints some fields that might be required to be setting
+    before sending a Workflow.
+    """
+    required_data = {}
+    if work_class['dataFields'].keys():
+        print ("To Create this Workflow, you'll probably need to provide\
+ below data:")
+        required_data[
+            'Available Data Fields:'] = list(work_class['dataFields'].keys())
+        print ('\n'.join(work_class['dataFields'].keys())+'\n')
+        
+    if work_class['workflowGroups'].keys():
+        required_data['Workflow Groups:'
+                      ] = list(work_class['workflowGroups'].keys())
+        print("\nGroups to be populated with users:")        
+        print ('\n'.join(work_class['workflowGroups'].keys())+'\n')
+
+    if work_class['attachments']:
+        required_data['Attachments:'] = list(work_class['attachments'].keys())
+        print('\nAvailable Attachment Fields:')
+        print ('\n'.join(work_class['attachments'].keys())+'\n')
+
+    return required_data
+
+
+def _launchData(new_data, options):
+    """Adresses the provided data when calling startWorkflow's method to a
+    dictionary to be passed when creating the workflow.
+    """
+    if new_data['workflowGroups'].keys():            
+        for group in new_data['workflowGroups'].keys():
+            if options.get(group):
+                new_data['workflowGroups'][group][
+                    'value'] = options.get(group).split(', ')
+                
+    if new_data['dataFields'].keys():            
+        for data_field in new_data['dataFields'].keys():
+            if options.get(data_field):
+                new_data['dataFields'][data_field][
+                    'value'] = options.get(data_field)
+
+    subject = options.get('subject')
+    if subject:
+        new_data['systemProperties']['subject'] = subject
+
+    if new_data['attachments']:
+        for attachment in new_data['attachments'].keys():
+            if options.get(
+                attachment) and options.get('object_store'):
+                
+                d_id = options.get(attachment)
+                object_store = options.get('object_store')
+                document = {u'title':'Attachment',
+                            u'libraryType':3,
+                            u'libraryName':object_store,
+                            u'vsId':d_id,
+                            u'version':d_id,
+                            u'type':3,
+                            u'desc':u''}                    
+                new_data['attachments'][attachment][
+                    'value'] = document
+    return new_data
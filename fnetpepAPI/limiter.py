@@ -0,0 +1,136 @@
+#encoding=utf-8
+"""
+Adaptive concurrency limits for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import threading
+import time
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class AdaptiveLimiter(object):
+
+    """Limits how many requests are sent at the same time, adjusting the
+    limit with AIMD (additive increase, multiplicative decrease): every
+    limit successful requests, the limit grows by increase; when a request
+    fails (an exception, a 5xx or a 429 status) or takes longer than
+    latency_factor times the usual latency, it is multiplied by decrease.
+    The limit stays between minimum and maximum, and is decreased at most
+    once for the requests sent before the previous decrease, so one burst
+    of errors only counts once.
+
+    The usual latency is an average of the latency of successful requests.
+    Requests waiting for room are counted in waiting.
+    Usage:
+    >>> limiter = AdaptiveLimiter(initial=4, maximum=32)
+    >>> started = limiter.acquire()
+    >>> limiter.release(started, failed=False)
+    >>> limiter.stats() -> {'limit': 4.25, 'in_flight': 0, 'waiting': 0, ...}
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0,
+                 decrease=0.5, latency_factor=3.0, smoothing=0.05):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.smoothing = smoothing
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency = None
+        self.__counters = {'requests': 0, 'failures': 0, 'slow': 0,
+                           'decreases': 0, 'waited': 0.0}
+        self.__decreased = 0.0
+        self.__condition = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """Waits until there is room for one more request and returns the
+        time it started, to be passed to release().
+        """
+        with self.__condition:
+            if self.in_flight >= int(self.limit):
+                waited = time.time()
+                self.waiting += 1
+                try:
+                    while self.in_flight >= int(self.limit):
+                        self.__condition.wait()
+                finally:
+                    self.waiting -= 1
+                self.__counters['waited'] += time.time() - waited
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started, failed=False, elapsed=None):
+        """Frees the room taken by a request started at started and adjusts
+        the limit. elapsed defaults to the time since started; pass
+        failed=None when the request didn't say anything about the
+        server's health (like when it was interrupted).
+        """
+        if elapsed is None:
+            elapsed = time.time() - started
+        with self.__condition:
+            self.in_flight -= 1
+            if failed is not None:
+                self.__counters['requests'] += 1
+                slow = (not failed and self.latency is not None
+                        and elapsed > self.latency * self.latency_factor)
+                if failed or slow:
+                    self.__counters['failures' if failed else 'slow'] += 1
+                    if started >= self.__decreased:
+                        self.limit = max(self.limit * self.decrease,
+                                         self.minimum)
+                        self.__decreased = time.time()
+                        self.__counters['decreases'] += 1
+                else:
+                    self.limit = min(self.limit
+                                     + self.increase / self.limit,
+                                     self.maximum)
+                if not failed:
+                    if self.latency is None:
+                        self.latency = elapsed
+                    else:
+                        self.latency += self.smoothing * (elapsed
+                                                          - self.latency)
+            self.__condition.notify_all()
+
+    def stats(self):
+        """Returns the current limit, the requests in flight and waiting,
+        the usual latency and the counters: requests, failures, slow
+        requests, decreases and seconds spent waiting.
+        """
+        with self.__condition:
+            stats = dict(self.__counters)
+            stats.update({'limit': self.limit, 'in_flight': self.in_flight,
+                          'waiting': self.waiting, 'latency': self.latency})
+            return stats
+
+
+class RequestLimiter(object):
+
+    """Keeps separate AdaptiveLimiters for reads (GET requests, like
+    getTasks and getStep) and writes (PUT and POST, like lockTask,
+    updateTask and endTask), so slow writes don't hold back reads.
+    Usage:
+    >>> client = PEClient('server_name', '9080', 'user', 'password',
+    limiter=RequestLimiter(writes=AdaptiveLimiter(maximum=4)))
+    >>> client.limiter.stats()['reads']['limit']
+    """
+
+    def __init__(self, reads=None, writes=None):
+        self.reads = reads if reads is not None else AdaptiveLimiter()
+        self.writes = writes if writes is not None else \
+            AdaptiveLimiter(initial=2, maximum=8)
+
+    def forMethod(self, method):
+        """Returns the limiter for requests with the given HTTP method."""
+        if method.upper() in READ_METHODS:
+            return self.reads
+        return self.writes
+
+    def stats(self):
+        return {'reads': self.reads.stats(), 'writes': self.writes.stats()}
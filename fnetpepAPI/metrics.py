@@ -0,0 +1,245 @@
+#encoding=utf-8
+"""
+Request metrics for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import functools
+import inspect
+import threading
+from collections import deque, namedtuple
+
+RequestEvent = namedtuple('RequestEvent', 'operation method url status '
+                          'elapsed bytes_sent bytes_received error')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+_local = threading.local()
+
+
+def currentOperation():
+    """Returns the name of the public API method running in this thread,
+    or None.
+    """
+    return getattr(_local, 'operation', None)
+
+
+def instrumented(func):
+    """Decorates a PEClient or PE method so the requests it makes, directly
+    or through other methods, are tagged with its name. Only the outermost
+    decorated method counts: requests made by endTask on behalf of bulkEnd
+    are tagged 'bulkEnd'. Calls are counted in the instance's metrics.
+    """
+    name = func.__name__.split('__')[-1]
+
+    def enter(self, count=True):
+        if currentOperation() is not None:
+            return False
+        _local.operation = name
+        if count and getattr(self, 'metrics', None) is not None:
+            self.metrics.call(name)
+        return True
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(self, *args, **kwargs):
+            items = func(self, *args, **kwargs)
+            first = True
+            try:
+                while True:
+                    outermost = enter(self, count=first)
+                    first = False
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        if outermost:
+                            _local.operation = None
+                    yield item
+            finally:
+                items.close()
+        return generator
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        outermost = enter(self)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            if outermost:
+                _local.operation = None
+    return wrapper
+
+
+def inheritOperation(func):
+    """Returns func wrapped so that, when run in a worker thread, its
+    requests are tagged with the operation of the thread calling
+    inheritOperation.
+    """
+    operation = currentOperation()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = currentOperation()
+        _local.operation = previous or operation
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.operation = previous
+    return wrapper
+
+
+class Metrics(object):
+
+    """Thread safe collector of the requests sent by a PEClient. For each
+    operation (the public method that triggered the requests) it keeps the
+    number of calls and requests, a latency histogram, the bytes sent and
+    received and a counter per method and status code. Requests not made
+    by a public method are counted under the 'request' operation.
+
+    Hooks are called with a RequestEvent after every request, in the
+    thread that made it, so they must be quick. Errors raised by a hook
+    don't reach the API call that made the request; the last 100 are
+    kept in hook_errors, as (hook, error) tuples.
+    Usage:
+    >>> client.metrics.addHook(lambda event: log.debug('%s', event))
+    >>> client.metrics.snapshot()['updateTask']['requests_per_call'] -> 4.0
+    >>> print(client.metrics.toPrometheus())
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='fnetpep'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.__hooks = []
+        self.hook_errors = deque(maxlen=100)
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def addHook(self, hook):
+        """Registers a callable receiving a RequestEvent per request."""
+        with self.__lock:
+            self.__hooks.append(hook)
+
+    def removeHook(self, hook):
+        with self.__lock:
+            self.__hooks.remove(hook)
+
+    def reset(self):
+        """Clears every counter. Hooks are kept."""
+        with self.__lock:
+            self.__operations = {}
+
+    def call(self, operation):
+        """Counts one call of operation."""
+        with self.__lock:
+            self.__operation(operation)['calls'] += 1
+
+    def record(self, operation, method, url, status, elapsed, bytes_sent=0,
+               bytes_received=0, error=None):
+        """Counts one request and passes it to the hooks. status is None
+        when no response was received.
+        """
+        operation = operation or 'request'
+        event = RequestEvent(operation, method, url, status, elapsed,
+                             bytes_sent, bytes_received, error)
+        with self.__lock:
+            stats = self.__operation(operation)
+            stats['requests'] += 1
+            stats['seconds'] += elapsed
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            for n, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    stats['buckets'][n] += 1
+                    break
+            key = (method, str(status) if status is not None else 'error')
+            stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+            hooks = list(self.__hooks)
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                self.hook_errors.append((hook, e))
+
+    def snapshot(self):
+        """Returns the counters as a dictionary keyed by operation.
+        Histogram buckets are cumulative, as in Prometheus.
+        """
+        with self.__lock:
+            snapshot = {}
+            for operation, stats in self.__operations.items():
+                calls, requests = stats['calls'], stats['requests']
+                cumulative, buckets = 0, []
+                for bound, count in zip(self.buckets, stats['buckets']):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                snapshot[operation] = {
+                    'calls': calls,
+                    'requests': requests,
+                    'requests_per_call': (float(requests) / calls
+                                          if calls else None),
+                    'seconds': stats['seconds'],
+                    'avg_seconds': (stats['seconds'] / requests
+                                    if requests else None),
+                    'buckets': buckets,
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                    'statuses': dict(('%s %s' % key, count) for key, count
+                                     in stats['statuses'].items())}
+            return snapshot
+
+    def toPrometheus(self):
+        """Returns the counters in Prometheus' text exposition format."""
+        p = self.prefix
+        with self.__lock:
+            operations = sorted(self.__operations.items())
+            lines = ['# HELP %s_calls_total Calls of public API methods.' % p,
+                     '# TYPE %s_calls_total counter' % p]
+            for operation, stats in operations:
+                lines.append('%s_calls_total{operation="%s"} %d'
+                             % (p, operation, stats['calls']))
+            lines += ['# HELP %s_requests_total HTTP requests sent.' % p,
+                      '# TYPE %s_requests_total counter' % p]
+            for operation, stats in operations:
+                for (method, status), count in sorted(
+                        stats['statuses'].items()):
+                    lines.append('%s_requests_total{operation="%s",'
+                                 'method="%s",status="%s"} %d'
+                                 % (p, operation, method, status, count))
+            lines += ['# HELP %s_request_seconds HTTP request latency.' % p,
+                      '# TYPE %s_request_seconds histogram' % p]
+            for operation, stats in operations:
+                cumulative = 0
+                for bound, count in zip(self.buckets, stats['buckets']):
+                    cumulative += count
+                    lines.append('%s_request_seconds_bucket{operation="%s",'
+                                 'le="%s"} %d' % (p, operation, bound,
+                                                  cumulative))
+                lines.append('%s_request_seconds_bucket{operation="%s",'
+                             'le="+Inf"} %d' % (p, operation,
+                                                stats['requests']))
+                lines.append('%s_request_seconds_sum{operation="%s"} %r'
+                             % (p, operation, stats['seconds']))
+                lines.append('%s_request_seconds_count{operation="%s"} %d'
+                             % (p, operation, stats['requests']))
+            for name, key in (('request_bytes', 'bytes_sent'),
+                              ('response_bytes', 'bytes_received')):
+                lines += ['# HELP %s_%s_total Bytes of HTTP %s bodies.'
+                          % (p, name, name.split('_')[0]),
+                          '# TYPE %s_%s_total counter' % (p, name)]
+                for operation, stats in operations:
+                    lines.append('%s_%s_total{operation="%s"} %d'
+                                 % (p, name, operation, stats[key]))
+        return '\n'.join(lines) + '\n'
+
+    def __operation(self, operation):
+        stats = self.__operations.get(operation)
+        if stats is None:
+            stats = {'calls': 0, 'requests': 0, 'seconds': 0.0,
+                     'bytes_sent': 0, 'bytes_received': 0,
+                     'buckets': [0] * len(self.buckets), 'statuses': {}}
+            self.__operations[operation] = stats
+        return stats
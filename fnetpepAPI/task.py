@@ -0,0 +1,152 @@
+#encoding=utf-8
+"""
+Compact task representation for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import json
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+_interned = {}
+_MISSING = object()
+
+
+def _intern(value):
+    """Returns a shared copy of value, so repeated strings like queue names
+    are kept in memory only once. Works for str and unicode alike.
+    """
+    return _interned.setdefault(value, value)
+
+
+class Task(object):
+
+    """A queue element holding only the fields the API uses as attributes.
+    Queue names and other repeated strings are shared between tasks, and
+    the URIs holding the work object number are kept as a shared prefix
+    and suffix around it. Every other field is kept as compact JSON text
+    and only decoded the first time one of them is used.
+
+    A Task behaves like the dictionary it was created from, so it can be
+    passed to every PE method that takes a task.
+    Usage:
+    >>> tasks = pe.getTasks(queue, compact=True)
+    >>> tasks[0]['workObjectNumber']
+    >>> tasks[0].get('columns')
+    >>> tasks[0].toDict() -> the queue element as a dictionary
+    """
+
+    FIELDS = ('workObjectNumber', 'stepElement', 'ETag', 'queueName',
+              'milestones', 'stepName', 'subject', 'lockedBy')
+    URIS = ('stepElement', 'milestones')
+    SHARED = ('queueName', 'stepName')
+
+    __slots__ = FIELDS + ('_rest', '_extra')
+
+    def __init__(self, element):
+        rest = dict(element)
+        for field in self.FIELDS:
+            if field in rest:
+                self[field] = rest.pop(field)
+        self._extra = None
+        self._rest = json.dumps(rest, separators=(',', ':')) if rest \
+            else None
+
+    def __getitem__(self, key):
+        value = self.__get(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            self.__decoded()[key] = value
+            return
+        if key == 'workObjectNumber':
+            for uri in self.URIS:
+                if isinstance(getattr(self, uri, None), tuple):
+                    setattr(self, uri, self.__get(uri))
+        wob = getattr(self, 'workObjectNumber', None)
+        if key in self.URIS and wob and isinstance(value, basestring) \
+           and wob in value:
+            before, _, after = value.partition(wob)
+            value = _intern((before, after))
+        elif key in self.SHARED and value is not None:
+            value = _intern(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return self.__get(key) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Task) and self._extra is None \
+           and other._extra is None:
+            return self._rest == other._rest and all(
+                getattr(self, field, _MISSING) == getattr(other, field,
+                                                          _MISSING)
+                for field in self.FIELDS)
+        if isinstance(other, (Task, dict)):
+            return self.toDict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Task(%r)' % self.toDict()
+
+    def get(self, key, default=None):
+        value = self.__get(key)
+        return default if value is _MISSING else value
+
+    def keys(self):
+        keys = [field for field in self.FIELDS
+                if getattr(self, field, _MISSING) is not _MISSING]
+        return keys + list(self.__extras().keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    iteritems = items
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def copy(self):
+        return Task(self.toDict())
+
+    def toDict(self):
+        """Returns the task as a plain dictionary."""
+        return dict(self.items())
+
+    def __get(self, key):
+        if key not in self.FIELDS:
+            return self.__extras().get(key, _MISSING)
+        value = getattr(self, key, _MISSING)
+        if key in self.URIS and isinstance(value, tuple):
+            value = value[0] + self.workObjectNumber + value[1]
+        return value
+
+    def __extras(self):
+        if self._extra is None and self._rest is None:
+            return {}
+        return self.__decoded()
+
+    def __decoded(self):
+        if self._extra is None:
+            self._extra = json.loads(self._rest) if self._rest else {}
+            self._rest = None
+        return self._extra
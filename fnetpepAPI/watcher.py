@@ -0,0 +1,187 @@
+#encoding=utf-8
+"""
+Incremental Queue synchronization for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnetpepAPI.fnetpepAPI import _tasks
+from fnetpepAPI.metrics import inheritOperation, instrumented
+
+QueueEvent = namedtuple('QueueEvent', 'kind workbasket task previous')
+
+
+class QueueWatcher(object):
+
+    """Keeps a local index of the tasks in each Workbasket, keyed by
+    workObjectNumber, and reports what changed between polls as QueueEvent
+    tuples, with kind 'added', 'removed' or 'changed'. For 'changed', the
+    task held before is in 'previous'.
+
+    Each poll asks for the count of every Workbasket, in parallel, and
+    revalidates the pages of queue elements listed before with their ETags
+    (If-None-Match), so unchanged pages cost a "304 Not Modified" and only
+    changed ones are downloaded again. Changes that keep the count (a task
+    locked, commented or replaced by another) are found this way too. When
+    the server sends no ETags, only the Workbaskets whose count changed are
+    listed again, and the other changes are picked up by a full poll, which
+    lists every Workbasket, run every full_every polls. The first poll is
+    always full and reports every task as added.
+    Usage:
+    >>> watcher = QueueWatcher(pe, workbaskets=['Inbox'], full_every=10)
+    >>> for event in watcher.watch(interval=30):
+    ...     print event.kind, event.task['workObjectNumber']
+
+    Or with a callback, receiving each event:
+    >>> watcher = QueueWatcher(pe, callback=dashboard.update)
+    >>> watcher.poll()
+
+    With compact=True the index holds Task objects instead of dictionaries.
+    """
+
+    def __init__(self, pe, workbaskets=None, full_every=10, workers=8,
+                 page_size=500, callback=None, compact=False):
+        self.pe = pe
+        self.client = pe.client
+        self.workbaskets = workbaskets
+        self.full_every = full_every
+        self.workers = workers
+        self.page_size = page_size
+        self.callback = callback
+        self.compact = compact
+        self.index = {}
+        self.counts = {}
+        self.pages = {}
+        self.errors = {}
+        self.stats = {'polls':0, 'refetched':0, 'skipped':0}
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+    @property
+    def metrics(self):
+        return self.client.metrics
+
+    def tasks(self, workbasket=None):
+        """Returns the indexed tasks from a Workbasket, or from all of
+        them.
+        """
+        if workbasket is not None:
+            return list(self.index.get(workbasket, {}).values())
+        return [task for tasks in self.index.values()
+                for task in tasks.values()]
+
+    @instrumented
+    def poll(self):
+        """Polls the Workbaskets once and returns the events found, after
+        passing each of them to the callback. Workbaskets that can't be
+        read are skipped and their errors kept in the errors variable.
+        """
+        workbaskets = self.client.workbaskets
+        names = self.workbaskets or sorted(workbaskets)
+        polls = self.stats['polls']
+        full = polls == 0 or bool(self.full_every
+                                  and polls % self.full_every == 0)
+        self.stats['polls'] += 1
+        self.errors = {}
+
+        def sync(name):
+            return self.__sync(name, workbaskets[name], full)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            found = list(pool.map(inheritOperation(sync), names))
+        events = [event for events in found for event in events]
+        if self.callback:
+            for event in events:
+                self.callback(event)
+        return events
+
+    def watch(self, interval=30, polls=None):
+        """Polls every interval seconds, yielding events as they are found,
+        until stop() is called or, if given, after polls polls.
+        """
+        self.__stopped.clear()
+        done = 0
+        while not self.__stopped.is_set():
+            for event in self.poll():
+                yield event
+            done += 1
+            if polls is not None and done >= polls:
+                break
+            self.__stopped.wait(interval)
+
+    def stop(self):
+        """Makes watch() return after the current poll."""
+        self.__stopped.set()
+
+    def __sync(self, name, uri, full):
+        """Updates the index for one Workbasket and returns its events."""
+        url = self.client.baseurl + uri + '/queueelements'
+        known = [] if full else self.pages.get(name, [])
+        try:
+            count = self.client.get(url + '/count')
+            count.raise_for_status()
+            count = count.json()['count']
+            unchanged = count == self.counts.get(name)
+            if not full and unchanged and not any(etag for etag, last, tasks
+                                                  in known):
+                with self.__lock:
+                    self.stats['skipped'] += 1
+                return []
+            pages, modified = self.__list(url, known)
+        except Exception as e:
+            self.errors[name] = e
+            return []
+        self.pages[name] = pages
+        self.counts[name] = count
+        if not modified:
+            with self.__lock:
+                self.stats['skipped'] += 1
+            return []
+        with self.__lock:
+            self.stats['refetched'] += 1
+        current = dict((task['workObjectNumber'], task)
+                       for etag, last, tasks in pages for task in tasks)
+        previous = self.index.get(name, {})
+        self.index[name] = current
+
+        events = [QueueEvent('removed', name, task, None)
+                  for wob, task in previous.items() if wob not in current]
+        for wob, task in current.items():
+            if wob not in previous:
+                events.append(QueueEvent('added', name, task, None))
+            elif task != previous[wob]:
+                events.append(QueueEvent('changed', name, task,
+                                         previous[wob]))
+        return events
+
+    def __list(self, url, known):
+        """Lists the queue elements at url page by page, sending the ETag of
+        each page in known with If-None-Match. Returns the pages, as (ETag,
+        lastRecord, tasks) tuples, and whether any of them changed.
+        """
+        pages = []
+        params = {'pageSize': self.page_size}
+        modified = False
+        while True:
+            cached = known[len(pages)] if len(pages) < len(known) else None
+            headers = {}
+            if cached and cached[0]:
+                headers['If-None-Match'] = cached[0]
+            response = self.client.get(url, params=dict(params),
+                                       headers=headers)
+            if cached and response.status_code == 304:
+                page = cached
+            else:
+                response.raise_for_status()
+                modified = True
+                body = response.json()
+                page = (response.headers.get('ETag'), body.get('lastRecord'),
+                        _tasks(body.get('queueElements') or [], self.compact))
+            pages.append(page)
+            if not page[1] or not page[2]:
+                break
+            params['lastRecord'] = page[1]
+        return pages, modified or len(pages) != len(known)
@@ -0,0 +1,336 @@
+#encoding=utf-8
+"""
+Queue worker for the Process Engine Python API.
+copyright: (c) 2016 by Wanderley Souza.
+license: Apache2, see LICENSE for more details.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from fnetpepAPI.metrics import instrumented
+
+COMPLETE = 'complete'
+ABORT = 'abort'
+RETURN = 'returnToSource'
+
+
+class QueueWorker(object):
+
+    """Drains Workbaskets by handing their tasks to registered handlers.
+    A handler is registered per Workbasket or per workclass (matched on the
+    task's 'workClassName'; workclass handlers win). Each task is locked
+    right before its handler is called with it. What it returns decides
+    what happens to the task:
+        - None or COMPLETE: the task is completed (see PE.completeTask),
+        - a dictionary: the task is completed with it as arguments, like
+          {'comment': u'Done', 'response': 'Approve', 'Amount': 10},
+        - ABORT: the task is unlocked, untouched,
+        - RETURN: the task is returned to its source.
+    When the handler raises, the task is unlocked and the error kept in the
+    errors variable.
+
+    Handlers run on up to workers threads, and up to backlog more tasks
+    wait for a thread. While workers + backlog tasks are taken,
+    Workbaskets aren't polled at all, and each poll only asks for as many
+    tasks as there is room for. A Workbasket that filled all the room is
+    polled again as soon as a task is done, one where fewer tasks were
+    found after min_interval seconds, and the interval doubles, up to
+    max_interval, while it stays empty.
+    Usage:
+    >>> worker = QueueWorker(pe, workers=16)
+    >>> @worker.handler(workbasket='Invoices')
+    ... def approve(task):
+    ...     return {'response': 'Approve'}
+    >>> worker.start()
+    >>> worker.stats() -> {'completed': 120, 'per_second': 11.8, ...}
+    >>> worker.stop()
+
+    stop(), or leaving run(), drops the tasks still waiting for a thread
+    and waits up to shutdown_timeout seconds for running handlers, before
+    unlocking the tasks they still hold. What those handlers return later
+    is ignored.
+    """
+
+    def __init__(self, pe, workers=8, backlog=None, min_interval=1.0,
+                 max_interval=30.0, workbaskets=None, shutdown_timeout=30.0):
+        self.pe = pe
+        self.client = pe.client
+        self.workers = workers
+        self.backlog = workers if backlog is None else backlog
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.workbaskets = workbaskets
+        self.shutdown_timeout = shutdown_timeout
+        self.handlers = {}
+        self.errors = deque(maxlen=100)
+        self.__counters = dict((name, 0) for name in (
+            'polls', 'locked', 'lock_failures', 'completed', 'aborted',
+            'returned', 'failed'))
+        self.__started = None
+        self.__finished = None
+        self.__held = {}
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    @property
+    def metrics(self):
+        return self.client.metrics
+
+    def register(self, handler, workbasket=None, workclass=None):
+        """Registers handler for the tasks of a Workbasket or of a
+        workclass.
+        Usage:
+        >>> worker.register(approve, workbasket='Invoices')
+        """
+        if (workbasket is None) == (workclass is None):
+            raise ValueError('Pass either a workbasket or a workclass')
+        if workbasket is not None:
+            self.handlers[('workbasket', workbasket)] = handler
+        else:
+            self.handlers[('workclass', workclass)] = handler
+
+    def handler(self, workbasket=None, workclass=None):
+        """Same as register(), as a decorator."""
+        def decorator(func):
+            self.register(func, workbasket, workclass)
+            return func
+        return decorator
+
+    def start(self):
+        """Runs the worker on a background thread."""
+        self.__stopping.clear()
+        self.__thread = threading.Thread(target=self.run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """Stops polling and shuts the worker down, as described above."""
+        self.__stopping.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def stats(self):
+        """Returns the worker's counters, the tasks held right now
+        (in_flight) and the tasks completed per second since it started.
+        """
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats['in_flight'] = len(self.__held)
+        elapsed = 0.0
+        if self.__started:
+            elapsed = (self.__finished or time.time()) - self.__started
+        stats['elapsed'] = elapsed
+        stats['per_second'] = stats['completed'] / elapsed if elapsed \
+            else 0.0
+        return stats
+
+    def run(self):
+        """Polls and processes tasks until stop() is called."""
+        self.__started = time.time()
+        self.__finished = None
+        names = self.__polled()
+        due = dict((name, 0.0) for name in names)
+        intervals = dict((name, self.min_interval) for name in names)
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while not self.__stopping.is_set():
+                self.__wake.clear()
+                for name in sorted(due, key=due.get):
+                    if self.__room() <= 0 or self.__stopping.is_set():
+                        break
+                    if due[name] > time.time():
+                        continue
+                    room = self.__room()
+                    submitted = self.__poll(name, pool)
+                    if submitted >= room:
+                        intervals[name] = 0.0
+                    elif submitted:
+                        intervals[name] = self.min_interval
+                    else:
+                        intervals[name] = min(max(intervals[name] * 2,
+                                                  self.min_interval),
+                                              self.max_interval)
+                    due[name] = time.time() + intervals[name]
+                if self.__room() <= 0 or not due:
+                    timeout = self.max_interval
+                else:
+                    timeout = max(min(due.values()) - time.time(), 0.0)
+                self.__wake.wait(timeout)
+        finally:
+            self.__shutdown(pool)
+            self.__finished = time.time()
+
+    def __polled(self):
+        """Returns the names of the Workbaskets to poll."""
+        names = set(name for kind, name in self.handlers
+                    if kind == 'workbasket')
+        if any(kind == 'workclass' for kind, name in self.handlers):
+            names.update(self.workbaskets or self.client.workbaskets)
+        return sorted(names)
+
+    def __room(self):
+        with self.__lock:
+            return self.workers + self.backlog - len(self.__held)
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counters[name] += 1
+
+    @instrumented
+    def __poll(self, name, pool):
+        """Lists as many tasks of a Workbasket as there is room for and
+        submits those with a handler. Returns how many were submitted.
+        """
+        self.__count('polls')
+        with self.__lock:
+            held = set(self.__held)
+        room = self.__room()
+        url = (self.client.baseurl + self.client.workbaskets[name]
+               + '/queueelements')
+        try:
+            found = self.client.get(url, params={'pageSize':room + len(held)})
+            found.raise_for_status()
+            tasks = found.json().get('queueElements') or []
+        except Exception as e:
+            self.errors.append((name, e))
+            return 0
+        submitted = 0
+        for task in tasks:
+            if submitted >= room or self.__stopping.is_set():
+                break
+            if task['workObjectNumber'] in held:
+                continue
+            handler = self.__handlerFor(name, task)
+            if handler is None:
+                continue
+            entry = [task, None, False, False]
+            with self.__lock:
+                self.__held[task['workObjectNumber']] = entry
+            entry[1] = pool.submit(self.__process, handler, entry)
+            submitted += 1
+        return submitted
+
+    def __handlerFor(self, name, task):
+        handler = self.handlers.get(('workclass', task.get('workClassName')))
+        if handler is None:
+            handler = self.handlers.get(('workbasket', name))
+        return handler
+
+    def __process(self, handler, entry):
+        """Locks a task, runs its handler and acts on the outcome. entry
+        holds the task, its future, whether it is locked (None once stop()
+        gave up on it) and whether its outcome is being acted on.
+        """
+        task = entry[0]
+        wob = task['workObjectNumber']
+        try:
+            locked = self.pe.lockTask(task)
+            if not locked.ok:
+                self.__count('lock_failures')
+                return
+            self.__count('locked')
+            task = task.copy()
+            task['ETag'] = locked.headers.get('ETag') or task['ETag']
+            with self.__lock:
+                abandoned = entry[2] is None
+                entry[0], entry[2] = task, True
+            if abandoned:
+                self.__release(task)
+                return
+            try:
+                outcome = handler(task)
+            except Exception as e:
+                self.errors.append((wob, e))
+                self.__count('failed')
+                if self.__claim(entry):
+                    self.__release(task)
+                return
+            if not self.__claim(entry):
+                return
+            if outcome is None or outcome == COMPLETE:
+                outcome = {}
+            if isinstance(outcome, dict):
+                result = self.pe.completeTask(task, locked=locked, **outcome)
+                counter = 'completed'
+            elif outcome == RETURN:
+                result = self.pe.returnToSource(task)
+                counter = 'returned'
+            elif outcome == ABORT:
+                result = self.pe.abort(task)
+                counter = 'aborted'
+            else:
+                self.errors.append((wob, ValueError(
+                    'Unknown handler outcome: %r' % (outcome,))))
+                self.__count('failed')
+                self.__release(task)
+                return
+            if getattr(result, 'ok', False):
+                self.__count(counter)
+            else:
+                self.errors.append((wob, getattr(result, 'text', result)))
+                self.__count('failed')
+                if counter == 'returned':
+                    self.__release(task)
+        except Exception as e:
+            self.errors.append((wob, e))
+            self.__count('failed')
+        finally:
+            with self.__lock:
+                if self.__held.get(wob) is entry:
+                    del self.__held[wob]
+            self.__wake.set()
+
+    def __claim(self, entry):
+        """Marks a task's outcome as being acted on, unless stop() has
+        already unlocked it. Returns whether the caller may act on it.
+        """
+        with self.__lock:
+            if entry[2] is None:
+                return False
+            entry[3] = True
+            return True
+
+    def __release(self, task):
+        """Unlocks a task, ignoring errors."""
+        try:
+            self.pe.abort(task)
+        except Exception as e:
+            self.errors.append((task['workObjectNumber'], e))
+
+    def __shutdown(self, pool):
+        """Drops the tasks waiting for a thread, waits for the running ones
+        and unlocks those still running after shutdown_timeout. Handlers
+        still running then can't act on their tasks anymore.
+        """
+        with self.__lock:
+            held = list(self.__held.values())
+        running = []
+        for entry in held:
+            if entry[1] is None:
+                continue
+            if entry[1].cancel():
+                with self.__lock:
+                    self.__held.pop(entry[0]['workObjectNumber'], None)
+            else:
+                running.append(entry[1])
+        pool.shutdown(wait=False)
+        wait(running, timeout=self.shutdown_timeout)
+        release = []
+        with self.__lock:
+            for entry in self.__held.values():
+                if entry[3]:
+                    continue
+                if entry[2]:
+                    release.append(entry[0])
+                entry[2] = None
+            self.__held = {}
+        for task in release:
+            self.__release(task)
+            self.__count('aborted')
@@ -10,9 +10,14 @@ config = {
     'download_url': 'https://github.com/wandss/FileNetPEAPI',
     'author_email': 'wandss@gmail.com',
     'version': '1.3.1',
-    'install_requires': ['nose', 'requests'],
+    'install_requires': ['nose', 'requests',
+                         'futures; python_version < "3"'],
+    'extras_require': {'async': ['aiohttp; python_version >= "3.5"'],
+                       'test': ['pytest']},
     'packages': ['fnetpepAPI'],
     'scripts': [],
+    'entry_points': {'console_scripts': [
+        'fnetpep-export = fnetpepAPI.export:main']},
     'name': 'fnetpepAPI'
 }
 
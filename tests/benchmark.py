@@ -0,0 +1,154 @@
+#encoding=utf-8
+"""
+Benchmarks fnetpepAPI against the stand-in server from tests/fakeserver.py,
+so no Process Engine is needed.
+
+For each scenario the number of HTTP requests, the bytes sent by the
+server, the wall time and the peak memory traced while it ran are reported.
+Tracing memory slows Python down, so the scenarios run twice: once for the
+timings and once for the memory. The fake server runs in the same process,
+so its allocations are part of the peak memory; compare numbers between
+runs, not against production.
+
+Usage:
+$ python -m tests.benchmark
+$ python -m tests.benchmark --latency 0.01 --queue-size 500 --json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from fnetpepAPI.fnetpepAPI import PEClient, PE
+from tests.fakeserver import FakePEServer
+
+WORKFLOW = 'ICNSequentialDocumentApproval'
+
+
+def measure(server, name, func, calls=1, trace=False):
+    """Runs func once and returns (func's result, a row with the
+    scenario's numbers). calls is how many operations func performs.
+    peak_kb is only measured when trace is True.
+    """
+    server.resetCounters()
+    if trace:
+        tracemalloc.start()
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    row = {'scenario': name,
+           'calls': calls,
+           'requests': server.requests,
+           'requests_per_call': float(server.requests) / calls,
+           'connections': server.connections,
+           'bytes': server.bytes_sent,
+           'wall': elapsed,
+           'ms_per_call': elapsed * 1000.0 / calls,
+           'peak_kb': peak / 1024.0 if peak is not None else None,
+           'paths': dict(server.paths)}
+    return result, row
+
+
+def run(options, trace=False):
+    """Runs every scenario against a new fake server and returns the
+    rows.
+    """
+    server = FakePEServer(app_spaces=options.app_spaces,
+                          roles_per_app=options.roles,
+                          workbaskets_per_role=options.workbaskets,
+                          queue_size=options.queue_size,
+                          latency=options.latency).start()
+    rows = []
+    try:
+        client, row = measure(server, 'bootstrap',
+                              lambda: PEClient('127.0.0.1', server.port,
+                                               'p8admin', 'password'),
+                              trace=trace)
+        rows.append(row)
+        pe = PE(client)
+
+        tasks, row = measure(server, 'getAllTasks', pe.getAllTasks,
+                             trace=trace)
+        rows.append(row)
+
+        count = min(options.tasks, len(tasks) // 2)
+        updates, ends = tasks[:count], tasks[count:count * 2]
+
+        def update():
+            for task in updates:
+                pe.updateTask(task, Note=u'benchmark')
+        rows.append(measure(server, 'updateTask', update, count, trace)[1])
+
+        def end():
+            for task in ends:
+                pe.endTask(task)
+        rows.append(measure(server, 'endTask', end, count, trace)[1])
+
+        def launch():
+            for n in range(options.tasks):
+                pe.startWorkflow(wf_name=WORKFLOW, Approvers='user001',
+                                 ICN_Instructions=u'launch %d' % n)
+        rows.append(measure(server, 'startWorkflow', launch,
+                            options.tasks, trace)[1])
+
+        client.close()
+    finally:
+        server.stop()
+    return rows
+
+
+def report(rows, out=sys.stdout):
+    """Prints rows as a table."""
+    header = ('scenario', 'calls', 'requests', 'req/call', 'conns',
+              'KB sent', 'wall s', 'ms/call', 'peak KB')
+    line = '%-14s %6s %9s %9s %6s %9s %8s %9s %9s'
+    print(line % header, file=out)
+    for row in rows:
+        peak = ('%.0f' % row['peak_kb'] if row['peak_kb'] is not None
+                else '-')
+        print(line % (row['scenario'], row['calls'], row['requests'],
+                      '%.1f' % row['requests_per_call'], row['connections'],
+                      '%.0f' % (row['bytes'] / 1024.0), '%.3f' % row['wall'],
+                      '%.2f' % row['ms_per_call'], peak), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds added to every response')
+    parser.add_argument('--app-spaces', type=int, default=2)
+    parser.add_argument('--roles', type=int, default=2,
+                        help='roles per app space')
+    parser.add_argument('--workbaskets', type=int, default=2,
+                        help='workbaskets per role')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='tasks in each workbasket')
+    parser.add_argument('--tasks', type=int, default=50,
+                        help='tasks updated, ended and launched')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    options = parser.parse_args(argv)
+    rows = run(options)
+    if tracemalloc:
+        for row, traced in zip(rows, run(options, trace=True)):
+            row['peak_kb'] = traced['peak_kb']
+    if options.json:
+        print(json.dumps(rows, indent=2, sort_keys=True))
+    else:
+        report(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+#encoding=utf-8
+"""
+Stand-in P8BPMREST server used by the benchmark suite.
+Implements the subset of IBM's Process Engine REST API used by
+fnetpepAPI, backed by in-memory data.
+
+Usage:
+>>> server = FakePEServer(app_spaces=3, roles_per_app=2, queue_size=500)
+>>> server.start()
+>>> client = PEClient('127.0.0.1', server.port, 'p8admin', 'password')
+>>> server.stop()
+"""
+
+import base64
+import hashlib
+import json
+import operator
+import socket
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+BASE_PATH = '/peengine/P8BPMREST/p8/bpm/v1/'
+
+FIELD_NAMES = {'F_WobNum': 'workObjectNumber',
+               'F_Subject': 'subject',
+               'F_StepName': 'stepName',
+               'F_Locked': 'lockedBy'}
+
+OPERATORS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt,
+             '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow responses (timeouts) are expected.
+        pass
+
+
+class FakePEServer(object):
+
+    """In-memory Process Engine. Every workbasket gets its own queue
+    holding queue_size elements. latency (seconds) is added to every
+    response, so connection reuse and concurrency effects are visible.
+    Any Basic auth is accepted, unless password is set; then only that
+    password is. Pages of queue elements are cut to max_page_size, like
+    engines capping the requested pageSize.
+    """
+
+    def __init__(self, app_spaces=2, roles_per_app=2, workbaskets_per_role=2,
+                 queue_size=50, workclasses=2, users=20, latency=0.0,
+                 etags=True, host='127.0.0.1', port=0, password=None,
+                 max_page_size=None):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.password = password
+        self.etags = etags
+        self.lock = threading.RLock()
+        self.requests = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self.paths = {}
+        self.appspaces = {}
+        self.roles = {}
+        self.queues = {}
+        self.steps = {}
+        self.workclasses = {}
+        self.launched = {}
+        self.users = ['user%03d' % n for n in range(users)] + ['p8admin']
+        self.groups = ['group%03d' % n for n in range(users)]
+        self.sessions = set()
+        for a in range(app_spaces):
+            app = 'App%d' % a
+            self.appspaces[app] = {'rolenames': 'appspaces/%s/rolenames' % app}
+            self.roles[app] = {}
+            for r in range(roles_per_app):
+                role = 'Role%d_%d' % (a, r)
+                baskets = {}
+                for w in range(workbaskets_per_role):
+                    queue = 'Queue%d_%d_%d' % (a, r, w)
+                    basket = 'WB%d_%d_%d' % (a, r, w)
+                    baskets[basket] = {
+                        'URI': 'queues/%s/workbaskets/%s' % (queue, basket)}
+                    self.queues[queue] = []
+                    for n in range(queue_size):
+                        self.addElement(queue, 'Task %d of %s' % (n, queue))
+                self.roles[app][role] = {'workbaskets': baskets}
+        for n in range(workclasses):
+            name = 'Workflow%d' % n
+            self.workclasses[name] = {'URI': 'workclasses/%s' % name}
+        self.workclasses['ICNSequentialDocumentApproval'] = {
+            'URI': 'workclasses/ICNSequentialDocumentApproval'}
+        self.server = _ThreadingServer((host, port), self.__handlerClass())
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def addElement(self, queue, subject, responses=None):
+        with self.lock:
+            wob = uuid.uuid4().hex.upper()
+            step = {'workObjectNumber': wob,
+                    'systemProperties': {'comment': None,
+                                         'subject': subject,
+                                         'responses': responses or [],
+                                         'selectedResponse': None,
+                                         'canReassign': True,
+                                         'canReturnToSource': True,
+                                         'queueName': queue},
+                    'dataFields': {'Amount': {'mode': 3, 'value': 0,
+                                              'type': 1,
+                                              'modified': False},
+                                   'Note': {'mode': 3, 'value': '',
+                                            'type': 2, 'modified': False},
+                                   'ReadOnly': {'mode': 1, 'value': 'x',
+                                                'type': 2,
+                                                'modified': False}},
+                    'workflowGroups': {},
+                    'attachments': {}}
+            self.steps[wob] = {'step': step, 'etag': 1, 'locked': None,
+                               'queue': queue}
+            self.queues[queue].append(wob)
+            return wob
+
+    def element(self, wob):
+        entry = self.steps[wob]
+        queue = entry['queue']
+        return {'workObjectNumber': wob,
+                'stepElement': 'queues/%s/stepelements/%s' % (queue, wob),
+                'milestones': 'rosters/DefaultRoster/wob/%s/milestones' % wob,
+                'ETag': str(entry['etag']),
+                'queueName': queue,
+                'subject': entry['step']['systemProperties']['subject'],
+                'stepName': 'General',
+                'lockedBy': entry['locked'],
+                'columns': {'F_Subject': entry['step'][
+                    'systemProperties']['subject']}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the listening socket. A server that was
+        never started just closes it, so its port refuses connections.
+        """
+        if self.thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+
+    def resetCounters(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+            self.bytes_sent = 0
+            self.paths = {}
+
+    def __handlerClass(self):
+        pe = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                self.request.setsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY, 1)
+                BaseHTTPRequestHandler.setup(self)
+                with pe.lock:
+                    pe.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_PUT(self):
+                self.dispatch('PUT')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+            def dispatch(self, method):
+                parsed = urlparse(self.path)
+                params = dict((k, v[-1]) for k, v in
+                              parse_qs(parsed.query).items())
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                path = parsed.path
+                with pe.lock:
+                    pe.requests += 1
+                    key = '%s %s' % (method, _route(path))
+                    pe.paths[key] = pe.paths.get(key, 0) + 1
+                if pe.latency:
+                    time.sleep(pe.latency)
+                if not path.startswith(BASE_PATH):
+                    return self.reply(404, {'UserMessage': {
+                        'Text': 'Not found'}})
+                status, payload, headers = pe.handle(
+                    method, path[len(BASE_PATH):].strip('/').split('/'),
+                    params, body, self.headers)
+                self.reply(status, payload, headers)
+
+            def reply(self, status, payload, headers=None):
+                if isinstance(payload, bytes):
+                    data = payload
+                elif payload is None:
+                    data = b''
+                else:
+                    data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+                with pe.lock:
+                    pe.bytes_sent += len(data)
+
+        return Handler
+
+    def handle(self, method, parts, params, body, headers):
+        with self.lock:
+            if not self.__authorized(headers):
+                return 401, {'UserMessage': {'Text': 'Unauthorized'}}, {}
+            extra = {}
+            if headers.get('Authorization'):
+                token = uuid.uuid4().hex
+                self.sessions.add(token)
+                extra['Set-Cookie'] = 'LtpaToken2=%s; Path=/' % token
+            status, payload, headers = self.__route(method, parts, params,
+                                                    body, headers)
+            headers.update(extra)
+            return status, payload, headers
+
+    def __authorized(self, headers):
+        basic = headers.get('Authorization')
+        if basic:
+            if self.password is None:
+                return True
+            user, _, password = base64.b64decode(
+                basic.split()[-1]).decode('utf-8').partition(':')
+            return password == self.password
+        cookie = headers.get('Cookie') or ''
+        for part in cookie.split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'LtpaToken2' and value in self.sessions:
+                return True
+        return False
+
+    def __route(self, method, parts, params, body, headers):
+        n = len(parts)
+        if parts == ['appspacenames']:
+            return 200, self.appspaces, {}
+        if parts == ['currentuser']:
+            return 200, {'name': 'p8admin', 'displayName': 'p8admin',
+                         'email': '', 'id': 1}, {}
+        if n == 3 and parts[0] == 'appspaces' and parts[2] == 'rolenames':
+            return 200, dict((r, {}) for r in
+                             self.roles.get(parts[1], {})), {}
+        if n == 4 and parts[0] == 'appspaces' and parts[2] == 'roles':
+            role = self.roles.get(parts[1], {}).get(parts[3])
+            if role is None:
+                return 404, {'UserMessage': {'Text': 'No role'}}, {}
+            return 200, role, {}
+        if parts == ['workclasses']:
+            return 200, self.workclasses, {}
+        if n == 2 and parts[0] == 'workclasses':
+            return 200, self.__workclass(parts[1]), {}
+        if parts[0] == 'queues' and n >= 4 and parts[2] == 'workbaskets':
+            return self.__workbasket(parts, params, headers)
+        if parts[0] == 'queues' and n == 4 and parts[2] == 'stepelements':
+            return self.__stepElement(method, parts[3], params, body,
+                                      headers)
+        if parts[0] == 'rosters' and n == 5 and parts[-1] == 'milestones':
+            return 200, {'milestones': []}, {}
+        if parts[0] == 'rosters' and n == 6 and method == 'POST':
+            self.launched[parts[5]] = json.loads(body.decode('utf-8'))
+            text = '{"URI":"rosters\\/DefaultRoster\\/wob\\/%s"}' % parts[5]
+            return 200, text.encode('utf-8'), {}
+        if parts in (['users'], ['groups']):
+            names = self.users if parts == ['users'] else self.groups
+            pattern = params.get('searchPattern', '')
+            found = [{'name': u, 'displayName': u, 'email': ''}
+                     for u in names if pattern in u]
+            found = found[:int(params.get('limit', 50))]
+            return 200, {parts[0]: found} if found else {}, {}
+        return 404, {'UserMessage': {'Text': 'Not found'}}, {}
+
+    def __workclass(self, name):
+        return {'systemProperties': {'workObjectNumber':
+                                     uuid.uuid4().hex.upper(),
+                                     'subject': name},
+                'dataFields': {'ICN_Instructions': {'value': '', 'mode': 3},
+                               'ICN_AllowReassign': {'value': False,
+                                                     'mode': 3}},
+                'workflowGroups': {'Approvers': {'value': []}},
+                'attachments': {'DocumentforReview': {'value': None}}}
+
+    def __workbasket(self, parts, params, headers):
+        queue, basket = parts[1], parts[3]
+        if queue not in self.queues:
+            return 404, {'UserMessage': {'Text': 'No queue'}}, {}
+        uri = 'queues/%s/workbaskets/%s' % (queue, basket)
+        elements = self.__query(queue, params)
+        if len(parts) == 4:
+            return 200, {'name': basket, 'queueName': queue,
+                         'queueElements': uri + '/queueelements'}, {}
+        if parts[4:] == ['queueelements', 'count']:
+            return 200, {'count': len(elements)}, {}
+        if parts[4:] == ['queueelements']:
+            start = int(params.get('lastRecord', 0))
+            size = int(params.get('pageSize', 0)) or len(elements)
+            if self.max_page_size:
+                size = min(size, self.max_page_size)
+            page = elements[start:start + size]
+            payload = {'queueElements': [self.element(w) for w in page]}
+            if start + size < len(elements):
+                payload['lastRecord'] = str(start + size)
+            if not self.etags:
+                return 200, payload, {}
+            etag = hashlib.md5(json.dumps(payload, sort_keys=True).encode(
+                'utf-8')).hexdigest()
+            if headers.get('If-None-Match') == etag:
+                return 304, None, {'ETag': etag}
+            return 200, payload, {'ETag': etag}
+        return 404, {'UserMessage': {'Text': 'Not found'}}, {}
+
+    def __query(self, queue, params):
+        elements = list(self.queues[queue])
+        expression = params.get('filter')
+        if expression:
+            values = json.loads(params.get('subsVars', '[]'))
+            clauses = [c.strip() for c in expression.split(' and ')]
+            for clause in clauses:
+                field, op, var = clause.split(None, 2)
+                if var.startswith(':'):
+                    value = values[ord(var[1:]) - ord('A')]
+                else:
+                    value = var.strip("'")
+                key = FIELD_NAMES.get(field, field)
+                compare = OPERATORS[op]
+                elements = [w for w in elements
+                            if compare(self.element(w).get(key), value)]
+        order = params.get('orderBy')
+        if order:
+            key = FIELD_NAMES.get(order, order)
+            elements.sort(key=lambda w: self.element(w).get(key),
+                          reverse=params.get('descending') == 'true')
+        return elements
+
+    def __stepElement(self, method, wob, params, body, headers):
+        entry = self.steps.get(wob)
+        if entry is None:
+            return 404, {'UserMessage': {'Text': 'No step'}}, {}
+        etag = str(entry['etag'])
+        head = {'ETag': etag} if self.etags else {}
+        if method == 'GET':
+            if self.etags and headers.get('If-None-Match') == etag:
+                return 304, None, head
+            return 200, entry['step'], head
+        match = params.get('If-Match') or headers.get('If-Match')
+        if self.etags and match != etag:
+            return 412, {'UserMessage': {'Text': 'ETag mismatch'}}, head
+        action = params.get('action')
+        if body:
+            update = json.loads(body.decode('utf-8'))
+            if action in ('saveAndUnlock', 'dispatch'):
+                entry['step']['systemProperties'].update(
+                    dict((k, v) for k, v in
+                         update.get('systemProperties', {}).items()
+                         if k in ('comment', 'selectedResponse')))
+                for k, v in update.get('dataFields', {}).items():
+                    if k in entry['step']['dataFields']:
+                        entry['step']['dataFields'][k]['value'] = v['value']
+        if action == 'lock':
+            entry['locked'] = 'p8admin'
+        elif action in ('abort', 'saveAndUnlock'):
+            entry['locked'] = None
+        elif action in ('dispatch', 'reassign', 'returnToSource'):
+            responses = entry['step']['systemProperties']['responses']
+            if action == 'dispatch' and responses and not entry['step'][
+                    'systemProperties']['selectedResponse']:
+                return 400, {'UserMessage': {
+                    'Text': 'Response required'}}, head
+            self.queues[entry['queue']].remove(wob)
+            del self.steps[wob]
+            return 200, {}, {}
+        else:
+            return 400, {'UserMessage': {'Text': 'Bad action'}}, head
+        if action == 'saveAndUnlock':
+            entry['etag'] += 1
+        head = {'ETag': str(entry['etag'])} if self.etags else {}
+        return 200, entry['step'], head
+
+
+def _route(path):
+    """Collapses a request path into a route name for the counters."""
+    parts = path[len(BASE_PATH):].strip('/').split('/')
+    if parts[0] == 'queues' and len(parts) > 2:
+        return 'queues/*/%s' % '/'.join(
+            p if i % 2 == 0 else '*' for i, p in enumerate(parts[2:]))
+    if parts[0] in ('appspaces', 'workclasses', 'rosters'):
+        return '/'.join(p if i % 2 == 0 else '*'
+                        for i, p in enumerate(parts))
+    return '/'.join(parts)
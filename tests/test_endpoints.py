@@ -0,0 +1,105 @@
+#encoding=utf-8
+"""
+Tests for fnetpepAPI.endpoints, alone and with PEClient against two
+stand-in servers from tests/fakeserver.py.
+
+Usage:
+$ python -m pytest tests
+"""
+
+import time
+
+import pytest
+
+from fnetpepAPI.endpoints import EndpointPool, ROUND_ROBIN
+from fnetpepAPI.fnetpepAPI import PEClient
+from tests.fakeserver import FakePEServer
+
+NODES = ['http://node1:9080', 'http://node2:9080']
+
+
+@pytest.fixture
+def nodes():
+    live = FakePEServer(app_spaces=1, roles_per_app=1,
+                        workbaskets_per_role=1, queue_size=5).start()
+    down = FakePEServer(app_spaces=1, roles_per_app=1,
+                        workbaskets_per_role=1, queue_size=5)
+    down.stop()
+    yield live, down
+    live.stop()
+
+
+def fail(pool, endpoint, times):
+    for n in range(times):
+        pool.acquire(endpoint + '/x', node=endpoint)
+        pool.release(endpoint, failed=True)
+
+
+def test_node_is_ejected_after_max_failures():
+    pool = EndpointPool(NODES, max_failures=3, eject_for=60)
+    fail(pool, NODES[0], 2)
+    assert pool.healthy() == NODES
+    fail(pool, NODES[0], 1)
+    assert pool.healthy() == [NODES[1]]
+    assert pool.stats()[NODES[0]]['ejections'] == 1
+    for n in range(5):
+        endpoint, url = pool.acquire(NODES[0] + '/peengine/x')
+        assert endpoint == NODES[1]
+        assert url == NODES[1] + '/peengine/x'
+        pool.release(endpoint)
+
+
+def test_ejected_node_is_tried_again_by_a_single_request():
+    pool = EndpointPool(NODES, max_failures=1, eject_for=0.05)
+    fail(pool, NODES[0], 1)
+    time.sleep(0.1)
+    picked = [pool.acquire(NODES[0] + '/x')[0] for n in range(3)]
+    assert picked.count(NODES[0]) == 1
+    for endpoint in picked:
+        pool.release(endpoint, failed=False)
+    assert pool.healthy() == NODES
+
+    fail(pool, NODES[0], 1)
+    time.sleep(0.1)
+    picked = [pool.acquire(NODES[0] + '/x')[0] for n in range(3)]
+    assert picked.count(NODES[0]) == 1
+    for endpoint in picked:
+        pool.release(endpoint, failed=endpoint == NODES[0])
+    assert pool.healthy() == [NODES[1]]
+    assert pool.stats()[NODES[0]]['ejections'] == 3
+
+
+def test_sticky_routes_keep_a_task_on_one_node():
+    pool = EndpointPool(NODES, strategy=ROUND_ROBIN, sticky=True)
+    url = NODES[0] + '/v1/queues/Inbox/stepelements/ABC123'
+    first = pool.acquire(url)[0]
+    pool.release(first)
+    for path in ('/v1/queues/Inbox/stepelements/ABC123?action=lock',
+                 '/v1/rosters/DefaultRoster/wob/ABC123/milestones'):
+        endpoint, routed = pool.acquire(NODES[0] + path)
+        pool.release(endpoint)
+        assert endpoint == first
+        assert routed == first + path
+    others = set()
+    for n in range(4):
+        endpoint = pool.acquire(NODES[0] + '/v1/queues')[0]
+        pool.release(endpoint)
+        others.add(endpoint)
+    assert others == set(NODES)
+
+
+def test_gets_fail_over_to_the_live_node(nodes):
+    live, down = nodes
+    client = PEClient(['127.0.0.1:%d' % down.port,
+                       '127.0.0.1:%d' % live.port], None, 'p8admin',
+                      'password', lazy=True)
+    down_node, live_node = client.endpoints.endpoints
+    for n in range(6):
+        response = client.get(client.baseurl + 'currentuser')
+        assert response.ok
+        assert response.url.startswith(live_node + '/')
+    stats = client.endpoints.stats()
+    assert stats[down_node]['failures'] == 3
+    assert stats[down_node]['ejected']
+    assert client.endpoints.healthy() == [live_node]
+    assert 'WB0_0_0' in client.workbaskets
@@ -0,0 +1,353 @@
+#encoding=utf-8
+"""
+Behaviour tests running fnetpepAPI against the stand-in server from
+tests/fakeserver.py.
+
+Usage:
+$ python -m pytest tests
+"""
+
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from fnetpepAPI.fnetpepAPI import PEClient, PE
+from fnetpepAPI.worker import QueueWorker
+from tests.fakeserver import FakePEServer
+
+
+@pytest.fixture
+def server():
+    server = FakePEServer(app_spaces=1, roles_per_app=1,
+                          workbaskets_per_role=2, queue_size=20).start()
+    yield server
+    server.stop()
+
+
+def connect(server, **kwargs):
+    kwargs.setdefault('pool_maxsize', 16)
+    return PEClient('127.0.0.1', server.port, 'p8admin', 'password',
+                    **kwargs)
+
+
+def test_discovery_finds_every_workbasket(server):
+    client = connect(server)
+    assert sorted(client.workbaskets) == ['WB0_0_0', 'WB0_0_1']
+    assert len(client.queue_urls) == 2
+
+
+def test_iter_tasks_pages_through_the_whole_queue(server):
+    pe = PE(connect(server))
+    tasks = list(pe.iterTasks(pe.getQueue('WB0_0_0'), page_size=7))
+    assert sorted(t['workObjectNumber'] for t in tasks) == \
+        sorted(server.queues['Queue0_0_0'])
+
+
+def test_worker_stop_leaves_abandoned_tasks_alone(server):
+    pe = PE(connect(server))
+    worker = QueueWorker(pe, workers=2, backlog=0, shutdown_timeout=0.2)
+    worker.register(lambda task: time.sleep(1.0), workbasket='WB0_0_0')
+    worker.start()
+    time.sleep(0.3)
+    worker.stop()
+    assert worker.stats()['aborted'] == 2
+    time.sleep(1.2)
+    stats = worker.stats()
+    assert stats['completed'] == 0
+    assert stats['aborted'] == 2
+    assert len(server.queues['Queue0_0_0']) == 20
+    assert not any(entry['locked'] for entry in server.steps.values())
+
+
+def test_failing_metrics_hook_does_not_change_results(server):
+    client = connect(server)
+    pe = PE(client)
+
+    def hook(event):
+        raise ValueError('broken metrics sink')
+    client.metrics.addHook(hook)
+    task = pe.getTasks(pe.getQueue('WB0_0_0'))[0]
+    assert pe.endTask(task, u'Done').ok
+    assert len(server.queues['Queue0_0_0']) == 19
+    assert client.metrics.hook_errors[-1][0] is hook
+
+
+def test_async_end_task_locks_with_task_etag(server):
+    pytest.importorskip('aiohttp')
+    import asyncio
+    from fnetpepAPI.asyncpe import AsyncPEClient, AsyncPE
+    needs_response = server.addElement('Queue0_0_0', 'Pick one',
+                                       responses=['Approve', 'Reject'])
+
+    async def run():
+        async with AsyncPEClient('127.0.0.1', server.port, 'p8admin',
+                                 'password') as client:
+            pe = AsyncPE(client)
+            tasks = await pe.getTasks(await pe.getQueue('WB0_0_0'))
+            by_wob = dict((t['workObjectNumber'], t) for t in tasks)
+            pending = by_wob.pop(needs_response)
+            server.resetCounters()
+            ended = await pe.endTask(list(by_wob.values())[0], u'Done')
+            requests = server.requests
+            refused = await pe.endTask(pending)
+            return ended, requests, refused
+
+    ended, requests, refused = asyncio.run(run())
+    assert ended.status == 200
+    assert requests == 2
+    assert refused.startswith('This task needs to be updated')
+    assert server.steps[needs_response]['locked'] is None
+    assert len(server.queues['Queue0_0_0']) == 20
+
+
+def test_unwritable_cache_dir_is_ignored(server, tmpdir):
+    blocker = tmpdir.join('not_a_dir')
+    blocker.write('')
+    client = connect(server, cache_dir=str(blocker.join('cache')))
+    assert 'WB0_0_0' in client.workbaskets
+    assert tmpdir.listdir() == [blocker]
+
+
+def test_update_options_clashing_with_data_fields_raise(server):
+    pe = PE(connect(server))
+    tasks = pe.getTasks(pe.getQueue('WB0_0_0'))[:2]
+    for wob in [t['workObjectNumber'] for t in tasks]:
+        server.steps[wob]['step']['dataFields']['workers'] = {
+            'mode': 3, 'value': 0, 'type': 1, 'modified': False}
+    server.steps[tasks[0]['workObjectNumber']]['step']['dataFields'][
+        'refresh'] = {'mode': 3, 'value': 0, 'type': 1, 'modified': False}
+    with pytest.raises(ValueError):
+        pe.updateTask(tasks[0], refresh=False, Amount=1)
+    assert pe.updateTask(tasks[0], Amount=1)['ETag'] != tasks[0]['ETag']
+    results = pe.bulkUpdate(tasks[1:], workers=4, Note='x')
+    assert not results[0].ok and 'workers' in results[0].error
+    assert pe.bulkUpdate(tasks[1:], Note='x')[0].ok
+    assert not any(entry['locked'] for entry in server.steps.values())
+
+
+def test_export_resume_skips_written_tasks_on_the_server(server, tmpdir):
+    from fnetpepAPI.export import export
+    pe = PE(connect(server))
+    checkpoint = str(tmpdir.join('export.ckpt'))
+    target = tmpdir.join('tasks.ndjson')
+    get_step = pe.getStep
+    calls = []
+
+    def failing(task):
+        calls.append(task)
+        if len(calls) > 7:
+            raise IOError('connection lost')
+        return get_step(task)
+    pe.getStep = failing
+    with target.open('a') as out:
+        with pytest.raises(IOError):
+            export(pe, out, ['WB0_0_0'], workers=1, read_ahead=0,
+                   milestones=False, checkpoint=checkpoint)
+    written = len(target.readlines())
+    assert written == 7
+
+    pe.getStep = get_step
+    listed = []
+    iter_tasks = pe.iterTasks
+
+    def counting(queue, page_size=100, compact=False):
+        for task in iter_tasks(queue, page_size, compact):
+            listed.append(task)
+            yield task
+    pe.iterTasks = counting
+    with target.open('a') as out:
+        result = export(pe, out, ['WB0_0_0'], milestones=False,
+                        checkpoint=checkpoint)
+    assert result['tasks'] == 20 - written
+    assert len(listed) == 20 - written
+    wobs = [json.loads(line)['workObjectNumber']
+            for line in target.readlines()]
+    assert len(wobs) == 20
+    assert sorted(set(wobs)) == sorted(server.queues['Queue0_0_0'])
+
+
+def test_refused_logins_are_not_counted(server):
+    server.password = 'password'
+    client = connect(server, session_auth=True, lazy=True)
+    url = client.baseurl + 'currentuser'
+    assert client.get(url).ok
+    assert client.logins == 1
+    server.password = 'changed'
+    server.sessions.clear()
+    server.resetCounters()
+    assert client.get(url).status_code == 401
+    assert server.requests == 2
+    for n in range(3):
+        server.resetCounters()
+        assert client.get(url).status_code == 401
+        assert server.requests == 1
+    assert client.logins == 1
+    assert client.session_auth
+    server.password = 'password'
+    assert client.get(url).ok
+    assert client.logins == 2
+
+
+def test_expired_session_logs_in_once(server):
+    client = connect(server, session_auth=True, lazy=True)
+    url = client.baseurl + 'currentuser'
+    assert client.get(url).ok
+    assert client.logins == 1
+    server.sessions.clear()
+    server.latency = 0.05
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        client.get(url).status_code)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [200] * 8
+    assert client.logins == 2
+    assert len(server.sessions) == 1
+
+
+def test_write_stops_sharing_of_earlier_get(server):
+    client = connect(server, coalesce=True)
+    pe = PE(client)
+    task = pe.getTasks(pe.getQueue('WB0_0_0'))[0]
+    url = client.baseurl + task['stepElement']
+    server.latency = 0.4
+    server.resetCounters()
+    threads = [threading.Thread(target=client.get, args=(url,)),
+               threading.Thread(target=client.get, args=(url,)),
+               threading.Thread(target=client.put, args=(url,),
+                                kwargs={'params': {'action': 'lock',
+                                                   'If-Match':
+                                                   task['ETag']}}),
+               threading.Thread(target=client.get, args=(url,))]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    assert client.coalesced_count == 1
+    assert server.requests == 3
+
+
+def test_each_node_keeps_its_own_session(server):
+    client = PEClient(['127.0.0.1:%d' % server.port,
+                       'localhost:%d' % server.port], None, 'p8admin',
+                      'password', session_auth=True, lazy=True)
+    server.resetCounters()
+    for n in range(10):
+        assert client.get(client.baseurl + 'currentuser').ok
+    assert server.requests == 10
+    assert client.logins == 2
+    server.sessions.clear()
+    server.resetCounters()
+    for n in range(10):
+        assert client.get(client.baseurl + 'currentuser').ok
+    assert server.requests == 12
+    assert client.logins == 4
+
+
+def test_get_tasks_filter_replaces_the_queue_filter_and_vars(server):
+    client = connect(server)
+    pe = PE(client)
+    wob = server.queues['Queue0_0_0'][4]
+    queue = pe.getQueue('WB0_0_0', query_filter='F_Subject = :A',
+                        subs_vars=['Task 4 of Queue0_0_0'])
+    assert queue['count'] == 1
+    sent = []
+    get = client.get
+
+    def recording(url, **kwargs):
+        sent.append(dict(kwargs.get('params') or {}))
+        return get(url, **kwargs)
+    client.get = recording
+    tasks = pe.getTasks(queue, query_filter='F_WobNum = :A',
+                        subs_vars=[wob])
+    assert [t['workObjectNumber'] for t in tasks] == [wob]
+    pe.getTasks(queue, query_filter="F_StepName = 'General'")
+    assert sent[-1]['filter'] == "F_StepName = 'General'"
+    assert 'subsVars' not in sent[-1]
+
+
+def test_iter_tasks_follows_last_record_past_capped_pages(server):
+    pe = PE(connect(server))
+    server.max_page_size = 6
+    tasks = list(pe.iterTasks(pe.getQueue('WB0_0_0'), page_size=10))
+    assert sorted(t['workObjectNumber'] for t in tasks) == \
+        sorted(server.queues['Queue0_0_0'])
+
+
+def test_get_all_tasks_deadline_covers_each_queue(server):
+    pe = PE(connect(server))
+    errors = {}
+    assert len(pe.getAllTasks(timeout=5, errors=errors)) == 40
+    assert errors == {}
+    server.latency = 0.3
+    started = time.time()
+    assert pe.getAllTasks(timeout=0.5, errors=errors) == []
+    assert time.time() - started < 1.0
+    assert sorted(errors) == ['WB0_0_0', 'WB0_0_1']
+    assert all(isinstance(e, requests.Timeout) for e in errors.values())
+    assert pe.errors is errors
+
+
+def test_async_reassign_needs_an_exact_user(server):
+    pytest.importorskip('aiohttp')
+    import asyncio
+    from fnetpepAPI.asyncpe import AsyncPEClient, AsyncPE
+
+    async def run():
+        async with AsyncPEClient('127.0.0.1', server.port, 'p8admin',
+                                 'password') as client:
+            pe = AsyncPE(client)
+            task = (await pe.getTasks(await pe.getQueue('WB0_0_0')))[0]
+            refused = await pe.reassignTask(task, 'User')
+            reassigned = await pe.reassignTask(task, 'user001')
+            return refused, reassigned.status
+
+    refused, status = asyncio.run(run())
+    assert refused == "User 'User' not found in Directory Service"
+    assert status == 200
+
+
+def test_step_cache_revalidates_with_etags(server):
+    client = connect(server)
+    pe = PE(client)
+    task = pe.getTasks(pe.getQueue('WB0_0_0'))[0]
+    first = pe.getStep(task)
+    server.resetCounters()
+    assert pe.getStep(task) == first
+    assert server.requests == 1
+    assert server.bytes_sent == 0
+    stats = pe.step_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 1, 1)
+
+
+def test_step_cache_drops_steps_changed_by_the_client(server):
+    client = connect(server)
+    pe = PE(client)
+    task = pe.getTasks(pe.getQueue('WB0_0_0'))[0]
+    url = client.baseurl + task['stepElement']
+    pe.getStep(task)
+    assert url in pe.step_cache
+    task = pe.saveAndUnlockTask(task, u'Changed')
+    assert url not in pe.step_cache
+    assert pe.getStep(task)['systemProperties']['comment'] == u'Changed'
+    assert pe.step_cache.stats()['misses'] == 2
+    pe.lockTask(task)
+    assert url not in pe.step_cache
+
+
+def test_step_cache_evicts_least_recently_used(server):
+    client = connect(server)
+    pe = PE(client, step_cache_size=2)
+    tasks = pe.getTasks(pe.getQueue('WB0_0_0'))[:3]
+    for task in tasks:
+        pe.getStep(task)
+    urls = [client.baseurl + task['stepElement'] for task in tasks]
+    assert [url in pe.step_cache for url in urls] == [False, True, True]
+    stats = pe.step_cache.stats()
+    assert (stats['evictions'], stats['size']) == (1, 2)
@@ -0,0 +1,82 @@
+#encoding=utf-8
+"""
+Tests for fnetpepAPI.limiter.
+
+Usage:
+$ python -m pytest tests
+"""
+
+import threading
+import time
+
+from fnetpepAPI.limiter import AdaptiveLimiter, RequestLimiter
+
+
+def test_limit_grows_by_increase_per_limit_successes():
+    limiter = AdaptiveLimiter(initial=4, maximum=32)
+    for n in range(4):
+        limiter.release(limiter.acquire(), failed=False, elapsed=0.01)
+    assert 4.9 < limiter.limit < 5.0
+    for n in range(600):
+        limiter.release(limiter.acquire(), failed=False, elapsed=0.01)
+    assert limiter.limit == 32
+    assert limiter.stats()['requests'] == 604
+
+
+def test_burst_of_errors_decreases_the_limit_once():
+    limiter = AdaptiveLimiter(initial=16, minimum=2)
+    started = [limiter.acquire() for n in range(8)]
+    for when in started:
+        limiter.release(when, failed=True)
+    assert limiter.limit == 8
+    stats = limiter.stats()
+    assert (stats['failures'], stats['decreases']) == (8, 1)
+
+    time.sleep(0.01)
+    limiter.release(limiter.acquire(), failed=True)
+    assert limiter.limit == 4
+    for n in range(5):
+        limiter.release(limiter.acquire(), failed=True)
+    assert limiter.limit == 2
+
+
+def test_latency_spike_counts_as_slow():
+    limiter = AdaptiveLimiter(initial=8, latency_factor=3.0)
+    for n in range(10):
+        limiter.release(limiter.acquire(), failed=False, elapsed=0.1)
+    assert abs(limiter.latency - 0.1) < 1e-9
+    before = limiter.limit
+    limiter.release(limiter.acquire(), failed=False, elapsed=0.2)
+    assert limiter.limit > before
+    limiter.release(limiter.acquire(), failed=False, elapsed=0.5)
+    assert limiter.limit < before
+    assert limiter.stats()['slow'] == 1
+
+
+def test_requests_over_the_limit_wait():
+    limiter = AdaptiveLimiter(initial=2, maximum=2)
+    held = [limiter.acquire(), limiter.acquire()]
+    acquired = threading.Event()
+
+    def third():
+        limiter.release(limiter.acquire(), failed=None)
+        acquired.set()
+    thread = threading.Thread(target=third)
+    thread.start()
+    time.sleep(0.1)
+    assert not acquired.is_set()
+    assert limiter.stats()['waiting'] == 1
+    limiter.release(held.pop(), failed=False)
+    assert acquired.wait(1)
+    thread.join()
+    stats = limiter.stats()
+    assert (stats['in_flight'], stats['waiting']) == (1, 0)
+    assert stats['waited'] > 0.05
+
+
+def test_reads_and_writes_have_separate_limits():
+    limiter = RequestLimiter()
+    assert limiter.forMethod('get') is limiter.reads
+    assert limiter.forMethod('PUT') is limiter.writes
+    assert limiter.forMethod('POST') is limiter.writes
+    assert limiter.writes.maximum == 8
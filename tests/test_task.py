@@ -0,0 +1,100 @@
+#encoding=utf-8
+"""
+Tests for fnetpepAPI.task, alone and passed to PE methods against the
+stand-in server from tests/fakeserver.py.
+
+Usage:
+$ python -m pytest tests
+"""
+
+import pytest
+
+from fnetpepAPI.fnetpepAPI import PEClient, PE
+from fnetpepAPI.task import Task
+from tests.fakeserver import FakePEServer
+
+ELEMENT = {'workObjectNumber': 'ABC123',
+           'stepElement': 'queues/Inbox/stepelements/ABC123',
+           'milestones': 'rosters/DefaultRoster/wob/ABC123/milestones',
+           'ETag': '1',
+           'queueName': 'Inbox',
+           'stepName': 'General',
+           'subject': 'Invoice 42',
+           'lockedBy': None,
+           'columns': {'F_Subject': 'Invoice 42'},
+           'canReassign': True}
+
+
+@pytest.fixture
+def server():
+    server = FakePEServer(app_spaces=1, roles_per_app=1,
+                          workbaskets_per_role=1, queue_size=5).start()
+    yield server
+    server.stop()
+
+
+def test_task_round_trips_to_the_same_dictionary():
+    task = Task(ELEMENT)
+    assert task.toDict() == ELEMENT
+    assert sorted(task.keys()) == sorted(ELEMENT)
+    assert len(task) == len(ELEMENT)
+    assert dict(task.items()) == ELEMENT
+    assert task['stepElement'] == ELEMENT['stepElement']
+    assert task.get('columns') == {'F_Subject': 'Invoice 42'}
+    assert task.get('missing', 'default') == 'default'
+    assert 'canReassign' in task and 'missing' not in task
+    with pytest.raises(KeyError):
+        task['missing']
+
+
+def test_uris_and_names_are_shared_between_tasks():
+    other = dict(ELEMENT, workObjectNumber='DEF456',
+                 stepElement='queues/Inbox/stepelements/DEF456',
+                 milestones='rosters/DefaultRoster/wob/DEF456/milestones')
+    first, second = Task(ELEMENT), Task(other)
+    assert first.stepElement is second.stepElement
+    assert first.queueName is second.queueName
+    assert second['milestones'] == other['milestones']
+
+
+def test_new_work_object_number_keeps_the_uris():
+    task = Task(ELEMENT)
+    task['workObjectNumber'] = 'XYZ789'
+    assert task['stepElement'] == ELEMENT['stepElement']
+    assert task['milestones'] == ELEMENT['milestones']
+    task['stepElement'] = 'queues/Inbox/stepelements/XYZ789'
+    assert task.stepElement == ('queues/Inbox/stepelements/', '')
+    assert task['stepElement'] == 'queues/Inbox/stepelements/XYZ789'
+
+
+def test_equality_copy_and_extras():
+    task = Task(ELEMENT)
+    assert task == Task(ELEMENT)
+    assert task == ELEMENT
+    assert task != dict(ELEMENT, ETag='2')
+    decoded = Task(ELEMENT)
+    decoded.get('columns')
+    assert decoded == task
+    copy = task.copy()
+    copy['ETag'] = '2'
+    copy['note'] = 'new'
+    assert task['ETag'] == '1' and 'note' not in task
+    assert copy != task
+    with pytest.raises(TypeError):
+        hash(task)
+
+
+def test_task_objects_go_through_update_and_complete(server):
+    client = PEClient('127.0.0.1', server.port, 'p8admin', 'password')
+    pe = PE(client)
+    first, second = pe.getTasks(pe.getQueue('WB0_0_0'), compact=True)[:2]
+    assert isinstance(first, Task)
+    updated = pe.updateTask(first, Amount=5)
+    assert isinstance(updated, Task)
+    assert updated['ETag'] != first['ETag']
+    assert updated['stepElement'] == first['stepElement']
+    step = server.steps[first['workObjectNumber']]['step']
+    assert step['dataFields']['Amount']['value'] == 5
+    assert pe.completeTask(updated, u'Done', Note='x').ok
+    assert pe.endTask(second).ok
+    assert len(server.queues['Queue0_0_0']) == 3
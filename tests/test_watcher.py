@@ -0,0 +1,89 @@
+#encoding=utf-8
+"""
+Tests for fnetpepAPI.watcher against the stand-in server from
+tests/fakeserver.py.
+
+Usage:
+$ python -m pytest tests
+"""
+
+import pytest
+
+from fnetpepAPI.fnetpepAPI import PEClient, PE
+from fnetpepAPI.watcher import QueueWatcher
+from tests.fakeserver import FakePEServer
+
+
+def watcher(server, **kwargs):
+    client = PEClient('127.0.0.1', server.port, 'p8admin', 'password')
+    kwargs.setdefault('page_size', 4)
+    kwargs.setdefault('full_every', 0)
+    return QueueWatcher(PE(client), workbaskets=['WB0_0_0'], **kwargs)
+
+
+def kinds(events):
+    return sorted((event.kind, event.task['workObjectNumber'])
+                  for event in events)
+
+
+@pytest.fixture(params=[True, False], ids=['etags', 'no-etags'])
+def server(request):
+    server = FakePEServer(app_spaces=1, roles_per_app=1,
+                          workbaskets_per_role=1, queue_size=10,
+                          etags=request.param).start()
+    yield server
+    server.stop()
+
+
+def test_first_poll_adds_every_task(server):
+    events = watcher(server).poll()
+    assert kinds(events) == sorted(('added', wob)
+                                   for wob in server.queues['Queue0_0_0'])
+
+
+def test_added_and_removed_tasks_are_reported(server):
+    queue = server.queues['Queue0_0_0']
+    watch = watcher(server)
+    watch.poll()
+    removed = queue[3]
+    with server.lock:
+        queue.remove(removed)
+        del server.steps[removed]
+    added = [server.addElement('Queue0_0_0', 'New %d' % n) for n in range(2)]
+    assert kinds(watch.poll()) == sorted([('removed', removed)]
+                                         + [('added', wob) for wob in added])
+    assert sorted(t['workObjectNumber'] for t in watch.tasks()) == \
+        sorted(queue)
+
+
+def test_change_keeping_the_count_is_found_with_etags(server):
+    watch = watcher(server)
+    watch.poll()
+    server.resetCounters()
+    assert watch.poll() == []
+    assert watch.stats['skipped'] == 1
+    if server.etags:
+        assert server.bytes_sent < 100 * 4
+
+    wob = server.queues['Queue0_0_0'][5]
+    server.steps[wob]['locked'] = 'someone'
+    events = watch.poll()
+    if not server.etags:
+        assert events == []
+        return
+    assert kinds(events) == [('changed', wob)]
+    assert events[0].task['lockedBy'] == 'someone'
+    assert events[0].previous['lockedBy'] is None
+
+
+def test_full_poll_finds_changes_without_etags(server):
+    watch = watcher(server, full_every=2)
+    watch.poll()
+    wob = server.queues['Queue0_0_0'][0]
+    server.steps[wob]['locked'] = 'someone'
+    if not server.etags:
+        assert watch.poll() == []
+    else:
+        watch.poll()
+        server.steps[wob]['locked'] = None
+    assert kinds(watch.poll()) == [('changed', wob)]